@@ -1,46 +1,143 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, g
 from flask_cors import CORS
-import pymongo
 from bson import ObjectId, errors
-import certifi
+import queue
 import random
+import threading
 from dotenv import load_dotenv
 import os
-from poker import Deck, best_value, value_to_str
-
-# Connect to MongoDB cluster
+import time
+import weakref
+from poker import cards_to_strs, hand_type_dict
+from game import GameState
+from events import TableEvents, format_event, snapshot_data
+from storage import open_storage, round_trips
+from history import ReplayError, group_hands, replay, to_ndjson
+import metrics
+from equity import exact_equity, exact_equity_cache, hand_strength, hand_strength_cache, monte_carlo_equity, visible_board_cards
+import preflop
+
+# Connect to the storage, STORAGE=memory keeps the games in this process for running without a database
+# STORAGE_DELAY adds seconds to every storage call, to load test the memory storage as if it were a database
 load_dotenv()
-cluster = pymongo.MongoClient(
-    os.getenv("MONGO_URI"),
-    tlsCAFile=certifi.where()
-)
-
-db = cluster["cluster0"]
-people_collection = db["people"]
-board_collection = db["board"]
+storage = open_storage(os.getenv("STORAGE"), os.getenv("MONGO_URI"), float(os.getenv("STORAGE_DELAY", 0)))
 
+# The Procfile serves the app with gunicorn's gevent workers, or with gthread workers when WORKER_CLASS=gthread
+# Under gevent each request and event stream is a greenlet, waiting on MongoDB, a lock or a sleep lets the others run,
+# so slow tables and open streams don't use up a worker's 32 threads as they do under gthread
 app = Flask(__name__, static_folder="../frontend/build", static_url_path="/")
-CORS(app)
+CORS(app, expose_headers=["ETag", "X-Mongo-Round-Trips"])
+
+# Create the storage's indexes and report any that are missing, CREATE_INDEXES=0 only reports
+# Runs in the background so a slow or unreachable database doesn't hold up the worker booting
+def bootstrap_storage():
+    try:
+        missing = storage.ensure_indexes(create=os.getenv("CREATE_INDEXES", "1") != "0")
+    except Exception as e:
+        app.logger.warning("Could not check the storage's indexes: %s", e)
+        return
+    if missing:
+        app.logger.warning("Missing indexes, queries will scan whole collections: %s", ", ".join(missing))
+
+threading.Thread(target=bootstrap_storage, daemon=True).start()
+
+# Games with no action for this many seconds are deleted with their people, 0 keeps them until the frontend deletes them
+# The unload beacon that deletes a game often never arrives
+game_idle_timeout = float(os.getenv("GAME_IDLE_TIMEOUT", 24 * 60 * 60))
+sweep_interval = float(os.getenv("SWEEP_INTERVAL", 10 * 60))
+games_reclaimed = metrics.Counter("poker_games_reclaimed_total", "Idle games deleted by the sweeper")
+documents_reclaimed = metrics.Counter("poker_documents_reclaimed_total", "Documents of idle games deleted by the sweeper", ["collection"])
+
+# Delete the idle games once
+def sweep_idle_games():
+    now = time.time()
+    game_ids, deleted = storage.delete_idle_games(now, now - game_idle_timeout)
+    for game_id in game_ids:
+        forget_game(game_id)
+    games_reclaimed.inc(amount=deleted["board"])
+    for collection, count in deleted.items():
+        documents_reclaimed.inc(collection, amount=count)
+    if deleted["board"]:
+        app.logger.info("Deleted %d idle games with %d people and %d history events", deleted["board"], deleted["people"], deleted["history"])
+    return deleted
+
+# Every worker sweeps, at jittered intervals so they rarely sweep at the same time
+def sweeper():
+    while True:
+        time.sleep(sweep_interval * random.uniform(0.5, 1.5))
+        try:
+            sweep_idle_games()
+        except Exception as e:
+            app.logger.warning("Sweeping idle games failed: %s", e)
+
+if game_idle_timeout > 0:
+    threading.Thread(target=sweeper, daemon=True).start()
+
+# Requests slower than this many seconds are logged, unset or 0 logs none
+slow_request_seconds = float(os.getenv("SLOW_REQUEST_SECONDS", 0))
+
+requests_total = metrics.Counter("http_requests_total", "Requests handled", ["endpoint", "method", "status"])
+request_seconds = metrics.Histogram("http_request_duration_seconds", "Time from the start of the request to the response", ["endpoint"])
+request_round_trips = metrics.Histogram("http_request_mongo_round_trips", "Commands sent to MongoDB per request", ["endpoint"],
+                                        buckets=(0, 1, 2, 3, 4, 6, 8, 12, 16, 32))
+# Heroku's router stamps X-Request-Start, the time before that is spent waiting for a free gunicorn worker
+queue_seconds = metrics.Histogram("http_request_queue_seconds", "Time between the router receiving the request and a worker starting it")
+
+@app.before_request
+def start_request():
+    round_trips.reset()
+    g.request_start = time.perf_counter()
+    request_start = request.headers.get("X-Request-Start", "").removeprefix("t=")
+    if request_start.isdigit():
+        queue_seconds.observe(max(time.time() - int(request_start) / 1000, 0))
+
+# Report how many times the request went to the database and record the request's metrics
+@app.after_request
+def report_round_trips(response):
+    count = round_trips.count()
+    response.headers["X-Mongo-Round-Trips"] = str(count)
+    if "request_start" in g:
+        seconds = time.perf_counter() - g.request_start
+        endpoint = request.endpoint or "unmatched"
+        requests_total.inc(endpoint, request.method, response.status_code)
+        request_seconds.observe(seconds, endpoint)
+        request_round_trips.observe(count, endpoint)
+        if 0 < slow_request_seconds <= seconds:
+            app.logger.warning("Slow request %s %s: %.3fs, %d MongoDB round trips, status %d",
+                               request.method, request.path, seconds, count, response.status_code)
+    return response
+
+# Request, database and evaluator metrics of this worker in Prometheus' text format
+@app.route("/metrics", methods=["GET"])
+def get_metrics():
+    return app.response_class(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+# Limits for equity requests, the time budget keeps a request well under gunicorn's worker timeout
+equity_samples = int(os.getenv("EQUITY_SAMPLES", 20000))
+equity_max_samples = int(os.getenv("EQUITY_MAX_SAMPLES", 200000))
+equity_time_budget = float(os.getenv("EQUITY_TIME_BUDGET", 2.0))
 
 @app.route("/")
 def index():
     return app.send_static_file("index.html")
 
-def generate_unique_id():
-    while True:
-        # Generate a random 6-digit ID
-        unique_id = str(random.randint(100000, 999999))
-        
-        # Check if the ID already exists in the collection
-        if not board_collection.find_one({"game_id": unique_id}):
-            return unique_id
+# Random 6-digit IDs to try before giving up on creating a game
+game_id_attempts = 20
+
+# Create a game with a random 6-digit ID, the unique index turns away IDs that are taken so there is no race between check and insert
+# Until the index is known to exist the storage reads the ID first
+def create_unique_game():
+    for _ in range(game_id_attempts):
+        game_id = str(random.randint(100000, 999999))
+        if storage.create_game(game_id, {"version": 0, "last_active": time.time()}):
+            return game_id
+    raise RuntimeError("No free game ID found")
 
 # Create a new game with id
 @app.route("/games", methods=["POST"])
 def create_game():
     try:
-        game_id = generate_unique_id()
-        board_collection.insert_one({"game_id": game_id})
+        game_id = create_unique_game()
         return jsonify({"game_id": str(game_id)}), 201
     except Exception as e:
         return jsonify({"error": str(e)}), 500
@@ -50,19 +147,102 @@ def create_game():
 @app.route("/games/delete/<string:game_id>", methods=["POST"])
 def delete_game(game_id):
     try:
-        board_collection.delete_one({"game_id": game_id})
-        people_collection.delete_many({"game_id": game_id})
+        with game_lock(game_id):
+            forget_game(game_id)
+            storage.delete_game(game_id)
         return jsonify("Game deleted"), 200
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+# Change the people or the board's settings outside of a hand's actions
+# write(board, people) returns the response body and status, and for statuses under 400 the change: the history event
+# and any of fields to set on the board, people_updates, new_people and deleted_people as storage.commit takes them
+# The change is committed at the version it was read at, again from a new read if an action saved first, so neither
+# overwrites the other. The game's lock keeps this worker's actions out, the version keeps out the other workers'
+# upsert creates a missing board first, otherwise a missing board is a 404
+def direct_write(game_id, write, upsert=False):
+    with game_lock(game_id):
+        flush_game(game_id)
+        for attempt in range(action_retries + 1):
+            if attempt:
+                action_conflicts.inc(request.endpoint)
+                time.sleep(random.uniform(0, 0.002 * attempt))
+            board = storage.get_board(game_id)
+            if board is None and upsert:
+                storage.bump_version(game_id, {"last_active": time.time()}, upsert=True)
+                board = storage.get_board(game_id)
+            if board is None:
+                return jsonify({"error": "Board not found"}), 404
+            body, status, change = write(board, storage.get_people(game_id))
+            if status >= 400:
+                return jsonify(body), status
+            # Bump the version of the board so clients polling the state see the change, and mark the game active
+            version = board.get("version")
+            now = time.time()
+            event = {**change.pop("event"), "version": (version or 0) + 1, "index": 0, "time": now}
+            board_update = {"$inc": {"version": 1}, "$set": {**change.pop("fields", {}), "last_active": now}}
+            if storage.commit(game_id, version, board_update, change.pop("people_updates", []), [event], **change):
+                return jsonify(body), status
+    return jsonify({"error": "The game kept changing, try again"}), 409
+
+# The person of people with the _id person_id, None if there isn't one
+# Raises errors.InvalidId if person_id isn't an ObjectId
+def find_person(people, person_id):
+    person_id = ObjectId(person_id)
+    return next((person for person in people if person["_id"] == person_id), None)
+
+# Convert the ids and cards of documents to strings for the frontend
+def person_to_json(person):
+    person["_id"] = str(person["_id"])
+    if "hand" in person:
+        person["hand"] = cards_to_strs(person["hand"])
+    return person
+
+def board_to_json(board):
+    if "_id" in board:
+        board["_id"] = str(board["_id"])
+    if "board_cards" in board:
+        board["board_cards"] = cards_to_strs(board["board_cards"])
+    return board
+
+# ?strength=1 adds each player's made hand and outs while the flop, turn or river is showing
+def wants_strength():
+    return request.args.get("strength", "").lower() in ("1", "true")
+
+# The made hand and outs of each player holding cards by _id, before the documents are converted to JSON
+def hand_strengths(game_id, board, people):
+    game_state = board.get("game_state")
+    if "board_cards" not in board or game_state is None or not 1 <= game_state <= 3:
+        return {}
+    board_cards = visible_board_cards(board["board_cards"], game_state)
+    strengths = {}
+    for person in people:
+        if "hand" in person:
+            strength = hand_strength(game_id, person["hand"], board_cards)
+            strengths[str(person["_id"])] = {
+                "score": strength["score"],
+                "score_str": strength["score_str"],
+                "outs": cards_to_strs(strength["outs"]),
+                "improves_to": strength["improves_to"]
+            }
+    return strengths
+
+def add_strengths(strengths, people):
+    for person in people:
+        if person["_id"] in strengths:
+            person["strength"] = strengths[person["_id"]]
+    return people
+
 # Get all people
 @app.route("/games/<string:game_id>/people", methods=["GET"])
 def get_people(game_id):
-    people = list(people_collection.find({"game_id": game_id}))
-    for person in people:
-        person["_id"] = str(person["_id"])
-    return jsonify(people)
+    live = live_documents(game_id)
+    people = live[1] if live else storage.get_people(game_id)
+    strengths = {}
+    if wants_strength():
+        board = live[0] if live else storage.get_board(game_id)
+        strengths = hand_strengths(game_id, board, people) if board else {}
+    return jsonify(add_strengths(strengths, [person_to_json(person) for person in people]))
 
 # Add a new person
 @app.route("/games/<string:game_id>/people", methods=["POST"])
@@ -70,9 +250,12 @@ def add_person(game_id):
     new_person = request.json
     new_person["cents"] = (int(float(new_person.get("dollars", 0)) * 100))
     new_person.pop("dollars", None) 
-    new_person["game_id"] = game_id
-    people_collection.insert_one(new_person)
-    return jsonify("Person added"), 201
+    new_person["_id"] = ObjectId()
+
+    def write(board, people):
+        return "Person added", 201, {"event": {"type": "add_person", "person": {**new_person, "game_id": game_id}}, "new_people": [new_person]}
+
+    return direct_write(game_id, write)
 
 # Modify an existing person
 @app.route("/games/<string:game_id>/people/<string:person_id>", methods=["PUT"])
@@ -80,33 +263,35 @@ def modify_person(game_id,person_id):
     updated_person = request.json
     updated_person["cents"] = (int(float(updated_person.get("dollars", 0)) * 100))
     updated_person.pop("dollars", None)
+
+    def write(board, people):
+        person = find_person(people, person_id)
+        if person is None:
+            return {"error": "Person not found"}, 404, None
+        return "Person updated", 200, {"event": {"type": "modify_person", "person": person_id, "fields": updated_person},
+                                       "people_updates": [(person["_id"], {"$set": updated_person})]}
+
     try:
-        result = people_collection.update_one({"_id": ObjectId(person_id), "game_id": game_id}, {"$set": updated_person})
-        if result.matched_count:
-            return jsonify("Person updated"), 200
-        else:
-            return jsonify({"error": "Person not found"}), 404
+        return direct_write(game_id, write)
     except errors.InvalidId:
         return jsonify({"error": "Invalid ObjectId"}), 400
 
 # Delete a person
 @app.route("/games/<string:game_id>/people/<string:person_id>", methods=["DELETE"])
 def delete_person(game_id, person_id):
-    try:
+    def write(board, people):
+        person = find_person(people, person_id)
+        if person is None:
+            return {"error": "Person not found"}, 404, None
+        change = {"event": {"type": "delete_person", "person": person_id}, "deleted_people": [person["_id"]]}
         # if the person was before the dealer or was the dealer, decrement the dealer
-        board = board_collection.find_one({"game_id": game_id})
-        if board:
-            dealer = board.get("dealer", -1)
-            people = list(people_collection.find({"game_id": game_id}).sort("_id", pymongo.ASCENDING))
-            people_ids = [str(person["_id"]) for person in people]
-            if dealer >= people_ids.index(person_id):
-                board_collection.update_one({"game_id": game_id}, {"$inc": {"dealer": -1}})
-
-        deleted_person = people_collection.find_one_and_delete({"_id": ObjectId(person_id), "game_id": game_id})
-        if deleted_person:
-            return jsonify("Person deleted"), 200
-        else:
-            return jsonify({"error": "Person not found"}), 404
+        dealer = board.get("dealer")
+        if dealer is not None and dealer >= people.index(person):
+            change["fields"] = {"dealer": dealer - 1}
+        return "Person deleted", 200, change
+
+    try:
+        return direct_write(game_id, write)
     except errors.InvalidId:
         return jsonify({"error": "Invalid ObjectId"}), 400
 
@@ -115,8 +300,11 @@ def delete_person(game_id, person_id):
 def modify_big_blind(game_id):
     try:
         big_blind_value = int(float(request.json.get("bigBlind")) * 100)
-        result = board_collection.update_one({"game_id": game_id}, {"$set": {"big_blind_value": big_blind_value}}, upsert=True)
-        return jsonify("Big blind set"), 200
+
+        def write(board, people):
+            return "Big blind set", 200, {"event": {"type": "big_blind", "value": big_blind_value}, "fields": {"big_blind_value": big_blind_value}}
+
+        return direct_write(game_id, write, upsert=True)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
@@ -124,7 +312,7 @@ def modify_big_blind(game_id):
 @app.route("/games/<string:game_id>/poker/big_blind", methods=["GET"])
 def get_big_blind(game_id):
     try:
-        board = board_collection.find_one({"game_id": game_id})
+        board = storage.get_board(game_id)
         if board:
             big_blind_value = board.get("big_blind_value", None)
             if big_blind_value is not None:
@@ -139,304 +327,437 @@ def get_big_blind(game_id):
 
 
 
+# Seconds an action's writes wait in memory before being flushed, 0 flushes them before responding
+# With a delay the tables are served from this worker's memory, so only use it with a single worker
+write_behind_delay = float(os.getenv("WRITE_BEHIND_DELAY", 0))
+live_games = {}
+pending_flushes = {}
+
+# Times an action is applied again to a fresh read when another request changed the game first
+action_retries = int(os.getenv("ACTION_RETRIES", 5))
+action_conflicts = metrics.Counter("poker_action_conflicts_total", "Actions that lost a race to another request and were applied again", ["endpoint"])
+
+# One lock per table so the threads of a worker apply its actions one at a time
+# Workers don't share locks, their actions are kept apart by the version on the board
+# A game's lock is dropped once no request holds it, so ids that were only read don't pile up
+game_locks = weakref.WeakValueDictionary()
+game_locks_lock = threading.Lock()
+
+def game_lock(game_id):
+    with game_locks_lock:
+        return game_locks.setdefault(game_id, threading.RLock())
+
+# Load a game's state with one read of the board and one of the people, unless it is live in memory
+# None if the game doesn't exist
+def load_state(game_id):
+    state = live_games.get(game_id)
+    if state is None:
+        board = storage.get_board(game_id)
+        if board is None:
+            return None
+        state = GameState(game_id, board, storage.get_people(game_id))
+        if write_behind_delay > 0:
+            live_games[game_id] = state
+    return state
+
+# Write the changes since the state was loaded if nobody else changed the game since
+# Returns False if the write lost the race, the state is then out of date
+def flush_state(state):
+    board_update, people_updates = state.changes()
+    if not storage.commit(state.game_id, state.loaded[0].get("version"), board_update, people_updates, state.history):
+        return False
+    state.mark_saved()
+    state.history = []
+    return True
+
+# Flush now, or after the write-behind delay so the actions in between share one write
+def save_state(state):
+    state.version = (state.version or 0) + 1
+    state.last_active = time.time()
+    # The events the action recorded are numbered within the version it saves
+    index = 0
+    for event in state.history:
+        if "version" not in event:
+            event.update(version=state.version, index=index, time=state.last_active)
+            index += 1
+    if write_behind_delay <= 0:
+        return flush_state(state)
+    if state.game_id not in pending_flushes:
+        timer = threading.Timer(write_behind_delay, flush_game, args=(state.game_id,))
+        timer.daemon = True
+        pending_flushes[state.game_id] = timer
+        timer.start()
+    return True
+
+# Flush a live game's pending writes and drop it from memory, the next action reads it again
+# So a table stays in memory only while it has writes waiting, and the database can be written directly after
+def flush_game(game_id):
+    with game_lock(game_id):
+        timer = pending_flushes.pop(game_id, None)
+        if timer:
+            timer.cancel()
+        state = live_games.pop(game_id, None)
+        if state and not flush_state(state):
+            # Another worker changed the game, so the actions kept in memory can't be written
+            app.logger.warning("Dropped the unsaved actions of game %s after a conflicting write", game_id)
+
+# Drop what this worker keeps of a game that is being deleted, without writing its pending actions
+def forget_game(game_id):
+    with game_lock(game_id):
+        timer = pending_flushes.pop(game_id, None)
+        if timer:
+            timer.cancel()
+        live_games.pop(game_id, None)
+    hand_strength_cache.discard(game_id)
+
+# The board and people documents of a game that is live in memory, None if it isn't
+def live_documents(game_id):
+    with game_lock(game_id):
+        state = live_games.get(game_id)
+        return state.to_documents() if state else None
+
+# Apply action(state) to a fresh read of the game and save it, again from a new read if another request saved first
+# action returns the response body and status, the state is only saved for statuses under 400
+def apply_action(game_id, action):
+    with game_lock(game_id):
+        for attempt in range(action_retries + 1):
+            if attempt:
+                action_conflicts.inc(request.endpoint)
+                time.sleep(random.uniform(0, 0.002 * attempt))
+            state = load_state(game_id)
+            if state is None:
+                return jsonify({"error": "Board not found"}), 404
+            body, status = action(state)
+            if status >= 400 or save_state(state):
+                return jsonify(body), status
+            live_games.pop(game_id, None)
+    return jsonify({"error": "The game kept changing, try again"}), 409
+
+# The seat of person_id if it is their turn, otherwise the error response
+def acting_seat(state, person_id):
+    seat = state.find_seat(person_id)
+    if not seat:
+        return None, ({"error": "Person not found"}, 404)
+    # A second tap of the same button arrives after the turn has moved on
+    if seat.index != state.current:
+        return None, ({"error": "Not this person's turn"}, 409)
+    return seat, None
+
 # Deal 2 cards to each player with money and deal board cards
 # Initialize a lot of game variables
 @app.route("/games/<string:game_id>/poker/deal", methods=["POST"])
 def deal(game_id):
+    def action(state):
+        # A second tap of deal would throw away the blinds of the hand the first one dealt
+        if state.game_state is not None and state.game_state < 4:
+            return {"error": "Hand in progress"}, 409
+        hand_strength_cache.discard(game_id)
+        if not state.deal():
+            return "Game over", 200
+        return "Successful deal", 200
+
     try:
-        undeal(game_id)
-        players = list(people_collection.find({"game_id": game_id, "cents": {"$gt": 0}}))
-        deck = Deck()
-        for player in players:
-            cards = [deck.deal_card() for _ in range(2)]
-            people_collection.update_one({"_id": player["_id"], "game_id": game_id}, {"$set": {"hand": cards}})
-        
-        people_collection.update_many({"game_id": game_id}, {"$set": {"betted": 0, "can_raise": True, "show": False, "won": 0, "score": 0, "score_str": ""}})
-        board_cards = [deck.deal_card() for _ in range(5)]
-        board_collection.update_one({"game_id": game_id}, {"$set": {"board_cards": board_cards, "game_state": 0, "pot": 0}}, upsert=True)
-
-        big_blind_value = board_collection.find_one({"game_id": game_id}).get("big_blind_value", 0)
-        board_collection.update_one({"game_id": game_id}, {"$set": {"min_raise": big_blind_value, "bet_per_person": big_blind_value}}, upsert=True)
-
-        people = list(people_collection.find({"game_id": game_id}).sort("_id", pymongo.ASCENDING))
-        valid_players = [person for person in people if person["cents"] > 0]
-
-        # Get the dealer, small blind, big blind, preflop leader, and postflop leader for the round
-        people = list(people_collection.find({"game_id": game_id}).sort("_id", pymongo.ASCENDING))
-        valid_players = [person for person in people if person["cents"] > 0]
-        
-        dealer = (board_collection.find_one({"game_id": game_id}).get("dealer", -1) + 1) % len(people)
-        while people[dealer]["cents"] == 0:
-            dealer = (dealer + 1) % len(people)
-        board_collection.update_one({"game_id": game_id}, {"$set": {"dealer": dealer}}, upsert=True)
-
-        if len(valid_players) == 2:
-            small_blind = dealer
-        else:
-            small_blind = (dealer + 1) % len(people)
-            while people[small_blind]["cents"] == 0:
-                small_blind = (small_blind + 1) % len(people)
-        
-        board_collection.update_one({"game_id": game_id}, {"$set": {"small_blind_player": small_blind}}, upsert=True)
-        big_blind = (small_blind + 1) % len(people)
-        while people[big_blind]["cents"] == 0:
-            big_blind = (big_blind + 1) % len(people)
-        board_collection.update_one({"game_id": game_id}, {"$set": {"big_blind_player": big_blind}}, upsert=True)
-
-        # Pay the small blind and big blind
-        small_blind_pays = min(people[small_blind]["cents"], big_blind_value // 2)
-        people_collection.update_one({"_id": people[small_blind]["_id"], "game_id": game_id}, {"$inc": {"cents": -small_blind_pays}})
-        people_collection.update_one({"_id": people[small_blind]["_id"], "game_id": game_id}, {"$inc": {"betted": small_blind_pays}})
-        board_collection.update_one({"game_id": game_id}, {"$inc": {"pot": small_blind_pays}})
-
-        big_blind_pays = min(people[big_blind]["cents"], big_blind_value)
-        people_collection.update_one({"_id": people[big_blind]["_id"],"game_id": game_id}, {"$inc": {"cents": -big_blind_pays}})
-        people_collection.update_one({"_id": people[big_blind]["_id"],"game_id": game_id}, {"$inc": {"betted": big_blind_pays}})
-        board_collection.update_one({"game_id": game_id}, {"$inc": {"pot": big_blind_pays}})
-
-        people = list(people_collection.find({"game_id": game_id}).sort("_id", pymongo.ASCENDING))
-        # Case for when only no moves left due to blinds
-        new_valid_players = [person for person in people if person["cents"] > 0]
-        if not new_valid_players or (len(new_valid_players) == 1 and new_valid_players[0]["betted"] == big_blind_value):
-            board_collection.update_one({"game_id": game_id}, {"$set": {"game_state": 4}})
-            people_collection.update_many({"game_id": game_id}, {"$set": {"show": True}})
-            evaluate_winner(game_id)
-            return jsonify("Game over"), 200
-        pre_flop_leader = (big_blind + 1) % len(people)
-        while people[pre_flop_leader]["cents"] == 0:
-            pre_flop_leader = (pre_flop_leader + 1) % len(people)
-        board_collection.update_one({"game_id": game_id}, {"$set": {"current_leader": pre_flop_leader}}, upsert=True)
-        board_collection.update_one({"game_id": game_id}, {"$set": {"current": pre_flop_leader}}, upsert=True)
-        post_flop_leader = big_blind if len(valid_players) == 2 else small_blind
-        board_collection.update_one({"game_id": game_id}, {"$set": {"post_flop_leader": post_flop_leader}}, upsert=True)
-        return jsonify("Successful deal"), 200
+        return apply_action(game_id, action)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 # Reset the game variables
 @app.route("/games/<string:game_id>/poker/undeal", methods=["POST"])
 def undeal(game_id):
+    def action(state):
+        hand_strength_cache.discard(game_id)
+        state.undeal()
+        return "Successful undeal", 200
+
     try:
-        people_collection.update_many({"game_id": game_id}, {
-            "$unset": {
-                "hand": "",
-                "betted": "",
-                "can_raise": "",
-                "show": "",
-                "won": "",
-                "score": "",
-                "score_str": ""
-            }
-        })
-        board_collection.update_one({"game_id": game_id}, {
-            "$unset": {
-                "board_cards": "",
-                "current_leader": "",
-                "current": "",
-                "post_flop_leader": "",
-                "pot": "",
-                "bet_per_person": "",
-                "game_state": "",
-                "min_raise": "",
-                "small_blind_player": "",
-                "big_blind_player": ""
-            }
-        })
-        return jsonify("Successful undeal"), 200
+        return apply_action(game_id, action)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 # Show the cards of a player
 @app.route("/games/<string:game_id>/poker/show/<string:person_id>", methods=["POST"])
 def show(game_id,person_id):
-    try:
-        current_show = people_collection.find_one({"_id": ObjectId(person_id),"game_id": game_id}).get("show", True)
-        new_show = not current_show
-        people_collection.update_one(
-            {"_id": ObjectId(person_id), "game_id": game_id},
-            {"$set": {"show": new_show}}
-        )
-        return jsonify("Successful show"), 200
-    except Exception as e:
-        return jsonify({"error": str(e)}), 500
+    # show is treated as True if it isn't set
+    def write(board, people):
+        person = find_person(people, person_id)
+        if person is None:
+            return {"error": "Person not found"}, 404, None
+        return "Successful show", 200, {"event": {"type": "show", "person": person_id},
+                                        "people_updates": [(person["_id"], {"$set": {"show": not person.get("show", True)}})]}
 
-# Increment the game state (0:4 - preflop, flop, turn, river, end)
-def increment_game_state(game_id):
     try:
-        board_collection.update_one({"game_id": game_id}, {"$inc": {"game_state": 1}})
-        board = board_collection.find_one({"game_id": game_id})
-        game_state = board.get("game_state", 0)
-        big_blind_value = board.get("big_blind_value", 0)
-        board_collection.update_one({"game_id": game_id}, {"$set": {"min_raise": big_blind_value}})
-        people_collection.update_many({ "game_id": game_id}, {"$set": {"can_raise": True}})
-
-        # Check if game state is 4 and evaluate winner
-        if game_state == 4:
-            people_collection.update_many({"game_id": game_id}, {"$set": {"show": True}})
-            evaluate_winner(game_id)
-        
-        return jsonify("Game state incremented"), 200
-    except Exception as e:
-        return jsonify({"error": str(e)}), 500
-
-# Increment the current player
-# Updates game state if needed
-def increment_current(game_id):
-    try:
-        people = list(people_collection.find({"game_id": game_id}).sort("_id", pymongo.ASCENDING))
-        people_collection.update_many({"game_id": game_id}, {"$set": {"show": False}})
-        players_with_cards = [person for person in people if "hand" in person]
-        if not players_with_cards or len(players_with_cards) == 1:
-            board_collection.update_one({"game_id": game_id}, {"$set": {"game_state": 4}})
-            evaluate_winner(game_id)
-            return jsonify("Game over"), 200
-        players_with_moves = [person for person in people if person["cents"] > 0 and "hand" in person]
-        current = board_collection.find_one({"game_id": game_id}).get("current", -1)
-        current_leader = board_collection.find_one({"game_id": game_id}).get("current_leader", -1)
-        next_round = False
-        while True:
-            current = (current + 1) % len(people)
-            if(current_leader == current):
-                if not players_with_moves or len(players_with_moves) == 1:
-                    board_collection.update_one({"game_id": game_id}, {"$set": {"game_state": 4}})
-                    people_collection.update_many({"game_id": game_id}, {"$set": {"show": True}})
-                    evaluate_winner(game_id)
-                    return jsonify("Game over"), 200
-                increment_game_state(game_id)
-                if board_collection.find_one({"game_id": game_id}).get("game_state", 0) == 4:
-                    return jsonify("Game over"), 200
-                current = board_collection.find_one({"game_id": game_id}).get("post_flop_leader", -1)
-                next_round = True
-            if people[current]["cents"] > 0 and "hand" in people[current]:
-                break
-        if next_round:
-            board_collection.update_one({"game_id": game_id}, {"$set": {"current_leader": current}})
-        board_collection.update_one({"game_id": game_id}, {"$set": {"current": current}})
-        return jsonify("Current incremented"), 200
+        return direct_write(game_id, write)
+    except errors.InvalidId:
+        return jsonify({"error": "Invalid ObjectId"}), 400
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 # Raise the bet by a certain amount
 @app.route("/games/<string:game_id>/poker/raise/<string:person_id>", methods=["POST"])
 def raise_cents(game_id,person_id):
+    def action(state):
+        seat, error = acting_seat(state, person_id)
+        if error:
+            return error
+        state.raise_cents(seat, original_amount)
+        return original_amount, 200
+
     try:
-        original_amount = int(request.json.get("amount"))    
-        person = people_collection.find_one({"_id": ObjectId(person_id), "game_id": game_id})
-        if person:
-            new_amount = original_amount + board_collection.find_one({"game_id": game_id}).get("bet_per_person", 0) - person.get("betted", 0)
-            people_collection.update_one({"_id": ObjectId(person_id), "game_id": game_id}, {"$inc": {"cents": -new_amount}})
-            people_collection.update_one({"_id": ObjectId(person_id), "game_id": game_id}, {"$inc": {"betted": new_amount}})
-            board_collection.update_one({"game_id": game_id}, {"$inc": {"pot": new_amount}})
-            current = board_collection.find_one({"game_id": game_id}).get("current", -1)
-            board_collection.update_one({"game_id": game_id}, {"$set": {"current_leader": current}})
-            board_collection.update_one({"game_id": game_id}, {"$inc": {"bet_per_person": original_amount}})
-            min_raise = board_collection.find_one({"game_id": game_id}).get("min_raise", 0)
-            if original_amount >= min_raise:
-                board_collection.update_one({"game_id": game_id}, {"$set": {"min_raise": original_amount}})
-                people_collection.update_many({"game_id": game_id}, {"$set": {"can_raise": True}})
-                people_collection.update_one({"_id": ObjectId(person_id), "game_id": game_id}, {"$set": {"can_raise": False}})
-            increment_current(game_id)
-            return jsonify(original_amount), 200
-        else:
-            return jsonify({"error": "Person not found"}), 500
+        original_amount = int(request.json.get("amount"))
+        return apply_action(game_id, action)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 # Call/check the bet
 @app.route("/games/<string:game_id>/poker/call/<string:person_id>", methods=["POST"])
 def call(game_id,person_id):
+    def action(state):
+        seat, error = acting_seat(state, person_id)
+        if error:
+            return error
+        return state.call(seat), 200
+
     try:
-        person = people_collection.find_one({"_id": ObjectId(person_id), "game_id": game_id})
-        people_collection.update_one({"_id": ObjectId(person_id), "game_id": game_id}, {"$set": {"can_raise": False}})
-        if person:
-            bet_per_person = board_collection.find_one({"game_id": game_id}).get("bet_per_person", 0)
-            amount = bet_per_person - person.get("betted", 0)
-            amount = min(amount, person["cents"])
-            people_collection.update_one({"_id": ObjectId(person_id), "game_id": game_id}, {"$inc": {"cents": -amount}})
-            people_collection.update_one({"_id": ObjectId(person_id), "game_id": game_id}, {"$inc": {"betted": amount}})
-            board_collection.update_one({"game_id": game_id}, {"$inc": {"pot": amount}})
-            increment_current(game_id)
-            return jsonify(amount), 200
-        else:
-            return jsonify({"error": "Person not found"}), 404
+        return apply_action(game_id, action)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
-        
+
 # Fold the hand
 @app.route("/games/<string:game_id>/poker/fold/<string:person_id>", methods=["POST"])
 def fold(game_id, person_id):
+    def action(state):
+        seat, error = acting_seat(state, person_id)
+        if error:
+            return error
+        state.fold(seat)
+        return "Successful fold", 200
+
     try:
-        people_collection.update_one({"_id": ObjectId(person_id), "game_id": game_id}, {"$unset": {"hand": ""}})
-        increment_current(game_id)
-        return jsonify("Successful fold"), 200
+        return apply_action(game_id, action)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
-        
+
+# The board and people of a table ready for JSON, None if the game doesn't exist
+def load_snapshot(game_id):
+    live = live_documents(game_id)
+    if live:
+        board, people = live
+    else:
+        board = storage.get_board(game_id)
+        if not board:
+            return None
+        people = storage.get_people(game_id)
+    return board_to_json(board), [person_to_json(person) for person in people]
+
+table_events = TableEvents(load_snapshot)
+
+# Seconds between keepalive comments on an idle event stream, under the router's idle timeout
+event_keepalive = float(os.getenv("EVENT_KEEPALIVE", 15))
+
+# Push a delta to the event streams after every request that changes a table
+@app.after_request
+def publish_change(response):
+    if request.method != "GET" and request.view_args and "game_id" in request.view_args and response.status_code < 400:
+        table_events.local_change(request.view_args["game_id"])
+    return response
+
+# Stream the table as Server-Sent Events, the full state first and then a delta after every change
+@app.route("/games/<string:game_id>/events", methods=["GET"])
+def stream_events(game_id):
+    table_events.watch(storage)
+    subscriber, snapshot = table_events.subscribe(game_id)
+
+    def stream():
+        try:
+            if snapshot:
+                yield format_event("state", snapshot_data(snapshot))
+            while True:
+                try:
+                    event, data = subscriber.get(timeout=event_keepalive)
+                except queue.Empty:
+                    yield ": keepalive\n\n"
+                    continue
+                yield format_event(event, data)
+                if event == "deleted":
+                    return
+        finally:
+            table_events.unsubscribe(game_id, subscriber)
+
+    return app.response_class(stream(), mimetype="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+# Stream the game's history as one JSON event per line, or one hand per line with ?format=hands
+@app.route("/games/<string:game_id>/history", methods=["GET"])
+def get_history(game_id):
+    flush_game(game_id)
+    events = storage.iter_events(game_id)
+    items = group_hands(events) if request.args.get("format") == "hands" else events
+    return app.response_class(to_ndjson(items), mimetype="application/x-ndjson")
+
+# The board and people rebuilt from the game's history, at ?version= or the latest
+@app.route("/games/<string:game_id>/replay", methods=["GET"])
+def get_replay(game_id):
+    try:
+        until_version = request.args.get("version")
+        flush_game(game_id)
+        state = replay(game_id, storage.iter_events(game_id), None if until_version is None else int(until_version))
+        board, people = state.to_documents()
+        return jsonify({
+            "version": board.get("version", 0),
+            "board": board_to_json(board),
+            "people": [person_to_json(person) for person in people]
+        }), 200
+    except ValueError:
+        return jsonify({"error": "Invalid version"}), 400
+    except ReplayError as e:
+        return jsonify({"error": str(e)}), 409
+
 # Get all board variables
 @app.route("/games/<string:game_id>/poker/board", methods=["GET"])
 def get_board(game_id):
     try:
-        board = board_collection.find_one({"game_id": game_id})
+        live = live_documents(game_id)
+        board = live[0] if live else storage.get_board(game_id)
         if board:
-            board["_id"] = str(board["_id"])
-            return jsonify(board), 200
+            if wants_strength():
+                board["strength"] = hand_strengths(game_id, board, live[1] if live else storage.get_people(game_id))
+            return jsonify(board_to_json(board)), 200
         else:
             return jsonify({"error": "Board not found"}), 404
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
-# Evaluate the winner of the round and distribute the pot
-def evaluate_winner(game_id):
+# Get the board and all people in one response
+# The ETag is the board's version, so an unchanged poll gets a 304 without reading the people
+@app.route("/games/<string:game_id>/state", methods=["GET"])
+def get_state(game_id):
     try:
-        board = board_collection.find_one({"game_id": game_id})
-        board_cards = board.get("board_cards", [])
-        pot = board.get("pot", 0)
-
-        people_with_cards = list(people_collection.find({"game_id": game_id, "hand": {"$exists": True}}))
-        people_values = []
-        for person in people_with_cards:
-            person_value = best_value(person["hand"] + board_cards)
-            people_values.append(person_value)
-            people_collection.update_one({"_id": person["_id"], "game_id": game_id}, {"$set": {"score": person_value}})
-            people_collection.update_one({"_id": person["_id"], "game_id": game_id}, {"$set": {"score_str": value_to_str(person_value)}})
-       
-        people = list(people_collection.find({"game_id": game_id}))
-        people_with_cards = [person for person in people if "hand" in person]
-
-        while pot > 0:
-            winners = []
-            best_score = max(people_values)
-            for i, person in enumerate(people_with_cards):
-                if person.get("score") == best_score:
-                    winners.append(person)
-                    person["score"] = 0
-                    people_values[i] = 0
-            random.shuffle(winners)
-            winners.sort(key=lambda x: (x["betted"], x["cents"]))
-            num_winners = len(winners)
-            for i in range(num_winners):
-                winner = winners[i]
-                winner_betted = winner.get("betted", 0)
-                winning_amount = 0
-                for person in people:
-                    money_won_from_person = min(person.get("betted", 0), winner_betted)
-                    person["betted"] = person.get("betted", 0) - money_won_from_person
-                    pot -= money_won_from_person
-                    winning_amount += money_won_from_person
-                win_per_winner = winning_amount // (num_winners - i)
-                remainder = winning_amount % (num_winners - i)
-                for j in range(i, num_winners):
-                    if remainder > 0:
-                        adjusted_win_per_winner = win_per_winner + 1
-                        remainder -= 1
-                    else :
-                        adjusted_win_per_winner = win_per_winner
-                    people_collection.update_one({"_id": winners[j]["_id"], "game_id": game_id}, {"$inc": {"cents": adjusted_win_per_winner}})
-                    people_collection.update_one({"_id": winners[j]["_id"], "game_id": game_id}, {"$inc": {"won": adjusted_win_per_winner}})
-        board_collection.update_one({"game_id": game_id}, {"$set": {"pot": 0}})
-        board_collection.update_one({"game_id": game_id}, {"$set": {"current": -1}})
-        board_collection.update_one({"game_id": game_id}, {"$set": {"current_leader": -1}})
-        return jsonify("Winner evaluated"), 200
+        live = live_documents(game_id)
+        board = live[0] if live else storage.get_board(game_id)
+        if not board:
+            return jsonify({"error": "Board not found"}), 404
+        etag = f"{game_id}-{board.get('version', 0)}"
+        if request.if_none_match.contains(etag):
+            response = app.response_class(status=304)
+        else:
+            people = live[1] if live else storage.get_people(game_id)
+            strengths = hand_strengths(game_id, board, people) if wants_strength() else {}
+            response = jsonify({
+                "version": board.get("version", 0),
+                "board": board_to_json(board),
+                "people": add_strengths(strengths, [person_to_json(person) for person in people])
+            })
+        response.set_etag(etag)
+        return response
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+# Get the win and tie percentages of every player still holding cards
+@app.route("/games/<string:game_id>/poker/equity", methods=["GET"])
+def get_equity(game_id):
+    try:
+        samples = max(1, min(int(request.args.get("samples", equity_samples)), equity_max_samples))
+        seed = request.args.get("seed")
+        seed = int(seed) if seed is not None else None
+        time_budget = min(float(request.args.get("time_budget", equity_time_budget)), equity_time_budget)
+    except ValueError:
+        return jsonify({"error": "Invalid samples, seed or time_budget"}), 400
+
+    try:
+        live = live_documents(game_id)
+        board = live[0] if live else storage.get_board(game_id)
+        if not board or "board_cards" not in board:
+            return jsonify({"error": "Board not found"}), 404
+        # After an all in the odds are for the board that was showing when betting stopped
+        game_state = board.get("all_in_street", board.get("game_state", 0))
+        board_cards = visible_board_cards(board["board_cards"], game_state)
+        people = live[1] if live else storage.get_people(game_id)
+        players = [person for person in people if "hand" in person]
+        hands = [player["hand"] for player in players]
+
+        # Enumerate every runout by default once all the betting is done or only the turn and river are left
+        exact = request.args.get("exact")
+        if exact is None:
+            exact = "all_in_street" in board or len(board_cards) >= 3
+        else:
+            exact = exact.lower() in ("1", "true")
+        result = None
+        if exact and hands:
+            # Leave half the budget for sampling in case the enumeration isn't cached and doesn't finish
+            start = time.monotonic()
+            result = exact_equity(hands, board_cards, time_budget / 2)
+            time_budget -= time.monotonic() - start
+        if result is None:
+            exact = False
+            result = monte_carlo_equity(hands, board_cards, samples, seed, time_budget)
+            # Every chunk was still queued behind other requests when the time budget ran out
+            if not result["samples"]:
+                return jsonify({"error": "The odds couldn't be sampled in time, try again"}), 503
+
+        run = result["samples"]
+        equity = []
+        for i, player in enumerate(players):
+            player_equity = {
+                "_id": str(player["_id"]),
+                "name": player.get("name", ""),
+                "win": 100 * result["wins"][i] / run,
+                "tie": 100 * result["ties"][i] / run
+            }
+            if "hand_types" in result:
+                player_equity["hand_types"] = {hand_type_dict[hand_type]: 100 * count / run for hand_type, count in enumerate(result["hand_types"][i]) if count}
+            equity.append(player_equity)
+        return jsonify({
+            "exact": exact,
+            "samples": result["samples"],
+            "seed": result.get("seed"),
+            "board_cards": cards_to_strs(board_cards),
+            "equity": equity,
+            "cache": exact_equity_cache.info()
+        }), 200
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+# Get a player's preflop equity from the precomputed table, against the other players still holding cards
+# ?opponents= asks for a different number of random hands, up to 9, and ?vs= for heads up against a hand class like QQ or AKs
+@app.route("/games/<string:game_id>/poker/preflop_odds/<string:person_id>", methods=["GET"])
+def get_preflop_odds(game_id, person_id):
+    try:
+        opponents = request.args.get("opponents")
+        opponents = int(opponents) if opponents is not None else None
+        if opponents is not None and opponents < 0:
+            raise ValueError
+        vs = request.args.get("vs")
+        vs = preflop.parse_class(vs) if vs is not None else None
+
+        live = live_documents(game_id)
+        board = live[0] if live else storage.get_board(game_id)
+        if not board:
+            return jsonify({"error": "Board not found"}), 404
+        people = live[1] if live else storage.get_people(game_id)
+        person = next((person for person in people if str(person["_id"]) == person_id), None)
+        if not person:
+            return jsonify({"error": "Person not found"}), 404
+        if "hand" not in person:
+            return jsonify({"error": "Person has no cards"}), 409
+
+        if opponents is None:
+            opponents = sum(1 for other in people if "hand" in other and other is not person)
+        opponents = min(opponents, preflop.max_opponents)
+        table = preflop.get_table()
+        hand_class = preflop.hand_class(person["hand"])
+        odds = {
+            "hand_class": preflop.class_name(hand_class),
+            "opponents": opponents,
+            # Alone in the hand there is nobody to beat
+            "equity": 100 * table.against_random(hand_class, opponents) if opponents > 0 else 100.0,
+            "samples": table.samples
+        }
+        if vs is not None:
+            odds["vs"] = {"hand_class": preflop.class_name(vs), "equity": 100 * table.heads_up(hand_class, vs)}
+        return jsonify(odds), 200
+    except (OSError, preflop.TableError):
+        return jsonify({"error": "The preflop equity table hasn't been built"}), 503
+    except ValueError:
+        return jsonify({"error": "Invalid opponents or vs"}), 400
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
@@ -0,0 +1,260 @@
+from collections import Counter, OrderedDict
+from concurrent.futures import ProcessPoolExecutor, wait
+from itertools import combinations, permutations
+import os
+import random
+import threading
+from poker import Deck, best_value, card_rank_keys, rank_table, hand_type_dict, value_to_str
+
+# Samples each pool task runs, small enough that the time budget can cut a run short
+chunk_size = 5000
+
+# Process pools shared by every request in this worker, created on first use
+# Exact enumerations get their own pool so one that outlives its request doesn't hold up sampling
+executors = {}
+executors_lock = threading.Lock()
+
+def get_executor(name="sample"):
+    if name not in executors:
+        with executors_lock:
+            if name not in executors:
+                executors[name] = ProcessPoolExecutor(max_workers=int(os.getenv("EQUITY_PROCESSES", os.cpu_count() or 1)))
+    return executors[name]
+
+# Board cards the players can see in each game state
+def visible_board_cards(board_cards, game_state):
+    if game_state <= 0:
+        return []
+    return board_cards[:min(game_state + 2, 5)]
+
+# Count wins and ties for each hand over random completions of the board
+def simulate(hands, board_cards, samples, seed):
+    rng = random.Random(seed)
+    known = set(board_cards).union(*hands)
+    deck = [card for card in Deck(rng).cards if card not in known]
+    missing = 5 - len(board_cards)
+    wins = [0] * len(hands)
+    ties = [0] * len(hands)
+    for _ in range(samples):
+        runout = board_cards + rng.sample(deck, missing)
+        values = [best_value(hand + runout) for hand in hands]
+        best = max(values)
+        winners = [i for i, value in enumerate(values) if value == best]
+        if len(winners) == 1:
+            wins[winners[0]] += 1
+        else:
+            for i in winners:
+                ties[i] += 1
+    return wins, ties
+
+# Monte Carlo win/tie counts for each hand, split into seeded chunks across the process pool
+# Chunks are only counted in order, so a seeded run that beats the time budget always returns the same counts
+def monte_carlo_equity(hands, board_cards, samples, seed=None, time_budget=None):
+    if seed is None:
+        seed = random.getrandbits(32)
+    result = {"seed": seed, "samples": 0, "wins": [0] * len(hands), "ties": [0] * len(hands)}
+    if len(hands) < 2:
+        result["samples"] = samples
+        result["wins"] = [samples] * len(hands)
+        return result
+
+    seeds = random.Random(seed)
+    chunks = [min(chunk_size, samples - start) for start in range(0, samples, chunk_size)]
+    futures = [get_executor().submit(simulate, hands, board_cards, chunk, seeds.getrandbits(64)) for chunk in chunks]
+    wait(futures, timeout=time_budget)
+
+    for chunk, future in zip(chunks, futures):
+        if not future.done():
+            break
+        wins, ties = future.result()
+        result["samples"] += chunk
+        result["wins"] = [a + b for a, b in zip(result["wins"], wins)]
+        result["ties"] = [a + b for a, b in zip(result["ties"], ties)]
+    for future in futures:
+        future.cancel()
+    return result
+
+# Bounded least recently used cache that counts its hits and misses
+class LRUCache:
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.hits += 1
+                self.entries.move_to_end(key)
+                return self.entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def discard(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def info(self):
+        return {"hits": self.hits, "misses": self.misses, "size": len(self.entries), "maxsize": self.maxsize}
+
+# Each game's made hands and outs keyed by (hand, visible board cards), so polls during a betting round reuse them
+# deal and undeal drop the game's entries, in the other workers they stay unused until they fall out of the cache
+hand_strength_cache = LRUCache(int(os.getenv("HAND_STRENGTH_CACHE_SIZE", 1024)))
+
+# Hand type of the board cards alone, with fewer than 5 cards only pairs, trips and quads are possible
+def board_hand_type(board_cards):
+    if len(board_cards) >= 5:
+        return best_value(board_cards) >> 20
+    counts = sorted(Counter(card % 13 for card in board_cards).values(), reverse=True) + [0]
+    if counts[0] == 4:
+        return 7
+    if counts[0] == 3:
+        return 3
+    if counts[0] == 2:
+        return 2 if counts[1] == 2 else 1
+    return 0
+
+# A hand's made hand on the board cards and its outs, the cards still unseen that would give it a better hand type
+# A card that improves the board as much, like one pairing it, makes the better hand for everyone and isn't an out
+# next_values is the hand's value with each unseen card, so the next street's made hand is read from the last street's entry
+def street_strength(hand, board_cards, previous=None):
+    if previous and board_cards[-1] in previous["next_values"]:
+        value = previous["next_values"][board_cards[-1]]
+    else:
+        value = best_value(hand + board_cards)
+    next_values = {}
+    if len(board_cards) < 5:
+        known = set(hand + board_cards)
+        next_values = {card: best_value(hand + board_cards + [card]) for card in range(52) if card not in known}
+    outs = [card for card, next_value in next_values.items()
+            if next_value >> 20 > value >> 20 and next_value >> 20 > board_hand_type(board_cards + [card])]
+    improves_to = Counter(hand_type_dict[next_values[card] >> 20] for card in outs)
+    return {"score": value, "score_str": value_to_str(value), "outs": outs, "improves_to": dict(improves_to), "next_values": next_values}
+
+# The made hand and outs of a hand from the flop on, cached per game
+def hand_strength(game_id, hand, board_cards):
+    entries = hand_strength_cache.get(game_id)
+    if entries is None:
+        entries = {}
+        hand_strength_cache.put(game_id, entries)
+    key = (tuple(hand), tuple(board_cards))
+    if key not in entries:
+        entries[key] = street_strength(list(hand), list(board_cards), entries.get((tuple(hand), tuple(board_cards[:-1]))))
+    return entries[key]
+
+# Exact results keyed by the canonical form of (hands, board cards)
+exact_equity_cache = LRUCache(int(os.getenv("EXACT_EQUITY_CACHE_SIZE", 4096)))
+
+suit_permutations = list(permutations(range(4)))
+
+# Relabelling suits doesn't change anyone's equity, so every suit relabelling of a spot shares the
+# smallest one as its key (AsAh vs KsKh and AcAd vs KcKd are the same spot)
+def canonical_form(hands, board_cards):
+    forms = []
+    for suits in suit_permutations:
+        mapped_hands = tuple(tuple(sorted(suits[card // 13] * 13 + card % 13 for card in hand)) for hand in hands)
+        mapped_board = tuple(sorted(suits[card // 13] * 13 + card % 13 for card in board_cards))
+        forms.append((mapped_hands, mapped_board))
+    return min(forms)
+
+# Count wins, ties and hand types for each hand over the runouts made of prefix plus count cards of rest
+def enumerate_runouts(hands, board_cards, prefix, rest, count):
+    wins = [0] * len(hands)
+    ties = [0] * len(hands)
+    hand_types = [[0] * len(hand_type_dict) for _ in hands]
+    hand_keys = [card_rank_keys[hand[0]] + card_rank_keys[hand[1]] for hand in hands]
+    players = range(len(hands))
+    for combo in combinations(rest, count):
+        runout = board_cards + prefix + list(combo)
+        key = 0
+        suit_counts = [0, 0, 0, 0]
+        for card in runout:
+            key += card_rank_keys[card]
+            suit_counts[card // 13] += 1
+        #without 3 of a suit on the board nobody can have a flush, so the rank table alone decides
+        if max(suit_counts) >= 3:
+            values = [best_value(hand + runout) for hand in hands]
+        else:
+            values = [rank_table[key + hand_key] for hand_key in hand_keys]
+        for i in players:
+            hand_types[i][values[i] >> 20] += 1
+        best = max(values)
+        if values.count(best) == 1:
+            wins[values.index(best)] += 1
+        else:
+            for i in players:
+                if values[i] == best:
+                    ties[i] += 1
+    return wins, ties, hand_types
+
+def collect_runouts(futures, players):
+    result = {"samples": 0, "wins": [0] * players, "ties": [0] * players, "hand_types": [[0] * len(hand_type_dict) for _ in range(players)]}
+    for future in futures:
+        wins, ties, hand_types = future.result()
+        result["wins"] = [a + b for a, b in zip(result["wins"], wins)]
+        result["ties"] = [a + b for a, b in zip(result["ties"], ties)]
+        result["hand_types"] = [[a + b for a, b in zip(total, counts)] for total, counts in zip(result["hand_types"], hand_types)]
+    result["samples"] = sum(result["hand_types"][0])
+    return result
+
+# Enumerations that are still running, so a request that outlives its time budget doesn't waste the work
+# A preflop spot is 1.7M runouts and seconds of CPU, so past the limit new preflop spots are sampled instead of queued
+# From the flop on there are at most 990 runouts, those are always enumerated
+exact_equity_pending = {}
+exact_equity_max_pending = int(os.getenv("EXACT_EQUITY_MAX_PENDING", 4))
+pending_lock = threading.RLock()
+
+def submit_exact_equity(key):
+    hands = [list(hand) for hand in key[0]]
+    board_cards = list(key[1])
+    known = set(board_cards).union(*hands)
+    deck = [card for card in range(52) if card not in known]
+    missing = 5 - len(board_cards)
+    #one task per lowest card of the runout
+    if missing == 0:
+        tasks = [([], [], 0)]
+    else:
+        tasks = [([deck[i]], deck[i + 1:], missing - 1) for i in range(len(deck) - missing + 1)]
+    futures = [get_executor("exact").submit(enumerate_runouts, hands, board_cards, *task) for task in tasks]
+    remaining = [len(futures)]
+
+    def finished(_):
+        with pending_lock:
+            remaining[0] -= 1
+            if remaining[0]:
+                return
+            exact_equity_pending.pop(key, None)
+        if all(not future.cancelled() and future.exception() is None for future in futures):
+            exact_equity_cache.put(key, collect_runouts(futures, len(hands)))
+
+    for future in futures:
+        future.add_done_callback(finished)
+    return futures
+
+# Exact win/tie and hand type counts for each hand over every remaining runout of the board
+# Returns None if the time budget runs out first, the enumeration carries on and is cached when it finishes
+# Also None without starting a preflop one when exact_equity_max_pending are already running
+def exact_equity(hands, board_cards, time_budget=None):
+    key = canonical_form(hands, board_cards)
+    result = exact_equity_cache.get(key)
+    if result is not None:
+        return result
+    with pending_lock:
+        if key not in exact_equity_pending:
+            if len(board_cards) < 3 and len(exact_equity_pending) >= exact_equity_max_pending:
+                return None
+            exact_equity_pending[key] = submit_exact_equity(key)
+        futures = exact_equity_pending[key]
+    wait(futures, timeout=time_budget)
+    if not all(future.done() for future in futures):
+        return None
+    return collect_runouts(futures, len(hands))
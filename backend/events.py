@@ -0,0 +1,184 @@
+import json
+import queue
+import threading
+import time
+import weakref
+from pymongo import errors
+from game import document_diff
+
+# Seconds before a request tries again to open a change stream that couldn't be opened
+watch_retry = 30
+# Seconds before reopening a change stream that broke, doubled after each failed try up to the most
+watch_backoff = 0.5
+watch_max_backoff = 30
+
+# Fan out table changes to the Server-Sent Events streams open in this worker
+# Each change is read once per worker and sent to every stream of the table as a delta of the last state sent
+class TableEvents:
+    def __init__(self, load_snapshot):
+        # load_snapshot(game_id) returns the JSON ready (board, people) of a table, None if it was deleted
+        self.load_snapshot = load_snapshot
+        self.subscribers = {}
+        self.snapshots = {}
+        self.board_ids = {}
+        # lock guards the dicts, a table's lock is held while it is read so its deltas are made in order
+        # Reads of different tables don't wait for each other, a table's lock goes away once nobody holds it
+        self.lock = threading.Lock()
+        self.table_locks = weakref.WeakValueDictionary()
+        self.watching = False
+        self.change_stream = False
+        self.retry_at = 0
+
+    def table_lock(self, game_id):
+        with self.lock:
+            return self.table_locks.setdefault(game_id, threading.Lock())
+
+    def subscribe(self, game_id):
+        subscriber = queue.Queue()
+        with self.table_lock(game_id):
+            with self.lock:
+                watched = game_id in self.subscribers
+            snapshot = None if watched else self.load_snapshot(game_id)
+            with self.lock:
+                if game_id not in self.subscribers:
+                    self.subscribers[game_id] = []
+                    self.snapshots[game_id] = snapshot
+                    self.remember_board_id(game_id)
+                self.subscribers[game_id].append(subscriber)
+                return subscriber, self.snapshots[game_id]
+
+    def unsubscribe(self, game_id, subscriber):
+        with self.lock:
+            subscribers = self.subscribers.get(game_id, [])
+            if subscriber in subscribers:
+                subscribers.remove(subscriber)
+            if not subscribers:
+                self.subscribers.pop(game_id, None)
+                self.snapshots.pop(game_id, None)
+                for board_id in [board_id for board_id, table in self.board_ids.items() if table == game_id]:
+                    del self.board_ids[board_id]
+
+    def remember_board_id(self, game_id):
+        snapshot = self.snapshots.get(game_id)
+        if snapshot and "_id" in snapshot[0]:
+            self.board_ids[snapshot[0]["_id"]] = game_id
+
+    # Read the table once and send what changed to each of its streams
+    def notify(self, game_id):
+        with self.table_lock(game_id):
+            with self.lock:
+                if game_id not in self.subscribers:
+                    return
+            new = self.load_snapshot(game_id)
+            with self.lock:
+                # The last stream closed while the table was read
+                if game_id not in self.subscribers:
+                    return
+                self.send(game_id, new)
+
+    # Send what changed since the last snapshot to every stream of the table, with lock held
+    def send(self, game_id, new):
+        old = self.snapshots[game_id]
+        if new is None:
+            if old is None:
+                return
+            event = ("deleted", {})
+        elif old is None:
+            event = ("state", snapshot_data(new))
+        else:
+            delta = state_delta(old, new)
+            if delta is None:
+                return
+            event = ("delta", delta)
+        self.snapshots[game_id] = new
+        self.remember_board_id(game_id)
+        for subscriber in self.subscribers[game_id]:
+            subscriber.put(event)
+
+    # Changes made by action endpoints in this worker, unless the change stream already reports every worker's
+    def local_change(self, game_id):
+        if not self.change_stream:
+            self.notify(game_id)
+
+    # Watch the boards so changes made by any worker reach the streams in this one
+    # Every change to a table bumps its board's version, so board changes are enough
+    # Returns False while there is no change stream and only this worker's changes are sent
+    # A stream that can't be opened is tried again by a request watch_retry seconds later
+    def watch(self, storage):
+        with self.lock:
+            if self.watching or time.monotonic() < self.retry_at:
+                return self.change_stream
+            self.watching = True
+        try:
+            board_ids = storage.watch_boards()
+        except (errors.PyMongoError, NotImplementedError):
+            with self.lock:
+                self.watching = False
+                self.retry_at = time.monotonic() + watch_retry
+            return False
+        self.change_stream = True
+        threading.Thread(target=self.relay, args=(storage, board_ids), daemon=True).start()
+        return True
+
+    # Read each table the stream reports changed, and reopen it after the last change it reported when it breaks,
+    # as it does during a primary election. While it is down local_change sends this worker's changes
+    # Once it is back every watched table is read again, in case the changes in between couldn't be resumed
+    def relay(self, storage, board_ids):
+        resume_token = None
+        backoff = watch_backoff
+        while True:
+            try:
+                for resume_token, board_id in board_ids:
+                    backoff = watch_backoff
+                    game_id = self.board_ids.get(board_id)
+                    if game_id:
+                        self.notify(game_id)
+            except errors.PyMongoError:
+                pass
+            self.change_stream = False
+            while True:
+                time.sleep(backoff)
+                backoff = min(backoff * 2, watch_max_backoff)
+                try:
+                    board_ids = storage.watch_boards(resume_token)
+                    break
+                except errors.PyMongoError:
+                    # The last change may have left the oplog, start from now instead
+                    resume_token = None
+            self.change_stream = True
+            with self.lock:
+                game_ids = list(self.subscribers)
+            for game_id in game_ids:
+                self.notify(game_id)
+
+def snapshot_data(snapshot):
+    board, people = snapshot
+    return {"version": board.get("version", 0), "board": board, "people": people}
+
+# What changed between two (board, people) snapshots, None if nothing did
+# Fields are given as the $set and $unset of the board and of each person by _id
+def state_delta(old, new):
+    old_board, old_people = old
+    board, people = new
+    old_people = {person["_id"]: person for person in old_people}
+    people_ids = {person["_id"] for person in people}
+    delta = {"version": board.get("version", 0)}
+    board_update = document_diff(old_board, board)
+    if board_update:
+        delta["board"] = board_update
+    people_updates = {}
+    for person in people:
+        person_update = document_diff(old_people.get(person["_id"], {}), person)
+        if person_update:
+            people_updates[person["_id"]] = person_update
+    if people_updates:
+        delta["people"] = people_updates
+    removed = [person_id for person_id in old_people if person_id not in people_ids]
+    if removed:
+        delta["removed"] = removed
+    if len(delta) == 1:
+        return None
+    return delta
+
+def format_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
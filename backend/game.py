@@ -0,0 +1,384 @@
+import copy
+import random
+import time
+from poker import Deck, best_value, value_to_str
+from metrics import Counter, Histogram
+
+showdown_scoring_seconds = Histogram("poker_showdown_scoring_seconds", "Time spent scoring the hands at a showdown",
+                                     buckets=(0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01))
+hands_scored = Counter("poker_hands_scored_total", "Hands scored with best_value at showdowns")
+
+# Fields of a person and of the board that only exist while a hand is dealt
+seat_hand_fields = ("hand", "betted", "can_raise", "show", "won", "score", "score_str")
+board_hand_fields = ("board_cards", "current_leader", "current", "post_flop_leader", "pot", "bet_per_person",
+                     "game_state", "min_raise", "small_blind_player", "big_blind_player", "all_in_street", "side_pots")
+board_fields = board_hand_fields + ("dealer", "big_blind_value", "version", "last_active")
+
+def count_bits(mask):
+    return bin(mask).count("1")
+
+# $set and $unset of the fields that differ between two versions of a document
+def document_diff(original, updated):
+    update = {}
+    set_fields = {key: value for key, value in updated.items() if key not in original or original[key] != value}
+    unset_fields = {key: "" for key in original if key not in updated}
+    if set_fields:
+        update["$set"] = set_fields
+    if unset_fields:
+        update["$unset"] = unset_fields
+    return update
+
+# A person at the table, fields that aren't set in the document are None
+class Seat:
+    __slots__ = ("id", "index", "bit", "cents") + seat_hand_fields + ("other",)
+
+    def __init__(self, person, index=0):
+        person = dict(person)
+        self.id = person.pop("_id")
+        self.index = index
+        self.bit = 1 << index
+        self.cents = person.pop("cents", 0)
+        for field in seat_hand_fields:
+            setattr(self, field, person.pop(field, None))
+        # name, game_id and anything else the frontend stores
+        self.other = person
+
+    def to_document(self):
+        person = {"_id": self.id, **self.other, "cents": self.cents}
+        for field in seat_hand_fields:
+            value = getattr(self, field)
+            if value is not None:
+                person[field] = value
+        return person
+
+# One table's board and seats (sorted by _id), with the betting rules applied in memory
+# Each action is also recorded in history as a compact event for the hand history log
+# The seats holding cards and the seats with money are kept as bitmasks by seat index,
+# so finding the next seat to act, the dealer or a blind doesn't walk the table
+class GameState:
+    __slots__ = ("game_id", "seats") + board_fields + ("other", "loaded", "cards_mask", "money_mask", "history")
+
+    def __init__(self, game_id, board, people):
+        board = dict(board or {})
+        board.pop("game_id", None)
+        self.game_id = game_id
+        self.seats = [Seat(person, index) for index, person in enumerate(sorted(people, key=lambda person: person["_id"]))]
+        for field in board_fields:
+            setattr(self, field, board.pop(field, None))
+        self.other = board
+        self.cards_mask = sum(seat.bit for seat in self.seats if seat.hand is not None)
+        self.money_mask = sum(seat.bit for seat in self.seats if seat.cents > 0)
+        self.history = []
+        # A hand dealt before the side pots were kept, its next bet would start a ledger without the bets before it
+        if self.pot and self.side_pots is None:
+            self.rebuild_side_pots()
+        self.mark_saved()
+
+    def record(self, event_type, **data):
+        self.history.append({"type": event_type, **data})
+
+    # Index of the first seat in mask after index, going round the table, None if mask is empty
+    def next_seat(self, mask, index):
+        later = mask >> (index + 1) << (index + 1) if index >= 0 else mask
+        if not later:
+            later = mask
+        return (later & -later).bit_length() - 1 if later else None
+
+    def to_documents(self):
+        board = {**self.other, "game_id": self.game_id}
+        for field in board_fields:
+            value = getattr(self, field)
+            if value is not None:
+                board[field] = value
+        return board, [seat.to_document() for seat in self.seats]
+
+    # Remember the current documents as the ones in the database
+    def mark_saved(self):
+        self.loaded = copy.deepcopy(self.to_documents())
+
+    # The board update and the (_id, update) of each changed person since the last save
+    def changes(self):
+        loaded_board, loaded_people = self.loaded
+        board, people = self.to_documents()
+        loaded_people = {person["_id"]: person for person in loaded_people}
+        people_updates = []
+        for person in people:
+            person_update = document_diff(loaded_people.get(person["_id"], {}), person)
+            if person_update:
+                people_updates.append((person["_id"], person_update))
+        return document_diff(loaded_board, board), people_updates
+
+    def find_seat(self, person_id):
+        for seat in self.seats:
+            if str(seat.id) == person_id:
+                return seat
+        return None
+
+    # Clear the variables of the last hand
+    def reset_hand(self):
+        for seat in self.seats:
+            for field in seat_hand_fields:
+                setattr(seat, field, None)
+        for field in board_hand_fields:
+            setattr(self, field, None)
+        self.cards_mask = 0
+
+    # Clear the last hand at the table's request
+    def undeal(self):
+        self.record("undeal")
+        self.reset_hand()
+
+    # Deal 2 cards to each player with money and deal board cards
+    # Returns False if the blinds leave nobody able to act and the hand went straight to showdown
+    def deal(self, deck=None):
+        seats = self.seats
+        self.reset_hand()
+        deck = deck or Deck()
+        self.record("deal", deck=list(deck.cards))
+        for seat in seats:
+            if seat.cents > 0:
+                seat.hand = [deck.deal_card() for _ in range(2)]
+        for seat in seats:
+            seat.betted, seat.can_raise, seat.show, seat.won, seat.score, seat.score_str = 0, True, False, 0, 0, ""
+        self.cards_mask = self.money_mask
+
+        big_blind_value = self.big_blind_value or 0
+        self.board_cards = [deck.deal_card() for _ in range(5)]
+        self.game_state = 0
+        self.pot = 0
+        self.min_raise = big_blind_value
+        self.bet_per_person = big_blind_value
+
+        # Get the dealer, small blind, big blind, preflop leader, and postflop leader for the round
+        valid_players = count_bits(self.money_mask)
+
+        dealer = self.next_seat(self.money_mask, ((-1 if self.dealer is None else self.dealer) + 1) % len(seats) - 1)
+        self.dealer = dealer
+
+        if valid_players == 2:
+            small_blind = dealer
+        else:
+            small_blind = self.next_seat(self.money_mask, dealer)
+        self.small_blind_player = small_blind
+
+        big_blind = self.next_seat(self.money_mask, small_blind)
+        self.big_blind_player = big_blind
+
+        # Pay the small blind and big blind
+        self.bet(seats[small_blind], min(seats[small_blind].cents, big_blind_value // 2))
+        self.bet(seats[big_blind], min(seats[big_blind].cents, big_blind_value))
+
+        # Case for when only no moves left due to blinds
+        money_mask = self.money_mask
+        if not money_mask or (count_bits(money_mask) == 1 and seats[self.next_seat(money_mask, -1)].betted == big_blind_value):
+            self.game_state = 4
+            self.all_in_street = 0
+            for seat in seats:
+                seat.show = True
+            self.evaluate_winner()
+            return False
+
+        pre_flop_leader = self.next_seat(money_mask, big_blind)
+        self.current_leader = pre_flop_leader
+        self.current = pre_flop_leader
+        self.post_flop_leader = big_blind if valid_players == 2 else small_blind
+        return True
+
+    # Move money from a seat into the pot
+    def bet(self, seat, amount):
+        betted = seat.betted or 0
+        seat.cents -= amount
+        seat.betted = betted + amount
+        self.pot = (self.pot or 0) + amount
+        if seat.cents <= 0:
+            self.money_mask &= ~seat.bit
+        if amount > 0:
+            self.add_to_side_pots(seat.index, betted, seat.betted)
+            if seat.cents == 0:
+                self.cap_side_pot(seat.betted)
+
+    # The side pots are layers of the seats' betted, each {"cap", "amount", "players"}
+    # A pot holds what was betted above the cap of the pot before it and up to its own cap, the last pot has no cap
+    # players are the indexes of the seats that paid into the pot
+    def add_to_side_pots(self, index, betted_before, betted_after):
+        if self.side_pots is None:
+            self.side_pots = []
+        low = 0
+        for pot in self.side_pots:
+            high = pot["cap"]
+            added = (betted_after if high is None else min(betted_after, high)) - max(betted_before, low)
+            if added > 0:
+                pot["amount"] += added
+                if index not in pot["players"]:
+                    pot["players"].append(index)
+            if high is None or betted_after <= high:
+                break
+            low = high
+        else:
+            # Betted past the cap of every pot, the rest opens the pot with no cap
+            self.side_pots.append({"cap": None, "amount": betted_after - max(betted_before, low), "players": [index]})
+
+    # Split the pot that a seat going all in for level cuts through, so the seat can't win more than it matched
+    def cap_side_pot(self, level):
+        low = 0
+        for i, pot in enumerate(self.side_pots):
+            high = pot["cap"]
+            if high == level:
+                return
+            if high is None or level < high:
+                players = pot["players"]
+                below = sum(min(self.seats[index].betted or 0, level) - low for index in players)
+                above = [index for index in players if (self.seats[index].betted or 0) > level]
+                split = [{"cap": level, "amount": below, "players": players}]
+                # Nobody betted past the all in yet, the pot above it opens with the next bet that does
+                if pot["amount"] > below:
+                    split.append({"cap": high, "amount": pot["amount"] - below, "players": above})
+                self.side_pots[i:i + 1] = split
+                return
+            low = high
+
+    # Build the side pots from the seats' betted, for hands dealt before the pots were kept
+    def rebuild_side_pots(self):
+        self.side_pots = None
+        for index, seat in enumerate(self.seats):
+            if seat.betted:
+                self.add_to_side_pots(index, 0, seat.betted)
+        for level in sorted({seat.betted for seat in self.seats if seat.betted and seat.cents == 0}):
+            self.cap_side_pot(level)
+
+    # Raise the bet by a certain amount
+    def raise_cents(self, seat, amount):
+        self.record("raise", seat=seat.index, amount=amount)
+        bet_per_person = self.bet_per_person or 0
+        self.bet(seat, amount + bet_per_person - (seat.betted or 0))
+        self.current_leader = -1 if self.current is None else self.current
+        self.bet_per_person = bet_per_person + amount
+        if amount >= (self.min_raise or 0):
+            self.min_raise = amount
+            for other in self.seats:
+                other.can_raise = True
+            seat.can_raise = False
+        self.increment_current()
+
+    # Call/check the bet, returns the amount called
+    def call(self, seat):
+        self.record("call", seat=seat.index)
+        seat.can_raise = False
+        amount = min((self.bet_per_person or 0) - (seat.betted or 0), seat.cents)
+        self.bet(seat, amount)
+        self.increment_current()
+        return amount
+
+    # Fold the hand
+    def fold(self, seat):
+        self.record("fold", seat=None if seat is None else seat.index)
+        if seat:
+            seat.hand = None
+            self.cards_mask &= ~seat.bit
+        self.increment_current()
+
+    # Increment the game state (0:4 - preflop, flop, turn, river, end)
+    def increment_game_state(self):
+        self.game_state = (self.game_state or 0) + 1
+        self.min_raise = self.big_blind_value or 0
+        for seat in self.seats:
+            seat.can_raise = True
+
+        # Check if game state is 4 and evaluate winner
+        if self.game_state == 4:
+            for seat in self.seats:
+                seat.show = True
+            self.evaluate_winner()
+
+    # Increment the current player
+    # Updates game state if needed
+    def increment_current(self):
+        seats = self.seats
+        for seat in seats:
+            seat.show = False
+        if count_bits(self.cards_mask) <= 1:
+            self.game_state = 4
+            self.evaluate_winner()
+            return
+        can_act = self.cards_mask & self.money_mask
+        current = -1 if self.current is None else self.current
+        current_leader = -1 if self.current_leader is None else self.current_leader
+        next_round = False
+        while True:
+            # Seats passed going round from current to the next one that can act and to the leader
+            following = self.next_seat(can_act, current)
+            to_actor = (following - current - 1) % len(seats) if following is not None else len(seats)
+            to_leader = (current_leader - current - 1) % len(seats) if 0 <= current_leader < len(seats) else len(seats)
+            if to_actor < to_leader:
+                current = following
+                break
+            # Back to the leader, the betting round is over
+            if count_bits(can_act) <= 1:
+                self.all_in_street = self.game_state or 0
+                self.game_state = 4
+                for seat in seats:
+                    seat.show = True
+                self.evaluate_winner()
+                return
+            self.increment_game_state()
+            if self.game_state == 4:
+                return
+            current = -1 if self.post_flop_leader is None else self.post_flop_leader
+            next_round = True
+            if current >= 0 and can_act & seats[current].bit:
+                break
+        if next_round:
+            self.current_leader = current
+        self.current = current
+
+    # Evaluate the winner of the round and distribute the pot
+    def evaluate_winner(self):
+        board_cards = self.board_cards or []
+        pot = self.pot or 0
+
+        start = time.perf_counter()
+        players_with_cards = [seat for seat in self.seats if seat.hand is not None]
+        for seat in players_with_cards:
+            seat.score = best_value(seat.hand + board_cards)
+            seat.score_str = value_to_str(seat.score)
+        showdown_scoring_seconds.observe(time.perf_counter() - start)
+        hands_scored.inc(amount=len(players_with_cards))
+
+        # Pay each side pot to the best hands among the seats still in that paid into it
+        # The odd cents of a split go to the winners who betted the least, ties broken at random
+        payouts = {seat: 0 for seat in self.seats}
+        # Seeded by the hand's cards so replaying the hand from its deck splits the odd cents the same way
+        tie_breaks = random.Random(",".join(str(card) for card in board_cards + [card for seat in players_with_cards for card in seat.hand]))
+        side_pots = self.side_pots or []
+        pot_contenders = [[self.seats[index] for index in side_pot["players"] if self.seats[index].hand is not None] for side_pot in side_pots]
+        # Everyone who paid into a pot folded after betting past an all in, the pot goes down to the one below it,
+        # and the main pot to whoever is still in
+        amounts = [side_pot["amount"] for side_pot in side_pots]
+        for i in range(len(side_pots) - 1, 0, -1):
+            if not pot_contenders[i]:
+                amounts[i - 1] += amounts[i]
+                amounts[i] = 0
+        if pot_contenders and not pot_contenders[0]:
+            pot_contenders[0] = players_with_cards
+        for contenders, amount in zip(pot_contenders, amounts):
+            if not contenders or not amount:
+                continue
+            best_score = max(seat.score for seat in contenders)
+            winners = [seat for seat in contenders if seat.score == best_score]
+            tie_breaks.shuffle(winners)
+            winners.sort(key=lambda seat: (seat.betted or 0, seat.cents))
+            win_per_winner, remainder = divmod(amount, len(winners))
+            for i, winner in enumerate(winners):
+                payouts[winner] += win_per_winner + (1 if i < remainder else 0)
+
+        for seat, payout in payouts.items():
+            if payout:
+                seat.cents += payout
+                seat.won = (seat.won or 0) + payout
+                if seat.cents > 0:
+                    self.money_mask |= seat.bit
+        self.record("showdown", payouts=[[seat.index, payout] for seat, payout in payouts.items() if payout])
+        self.pot = 0
+        self.side_pots = None
+        self.current = -1
+        self.current_leader = -1
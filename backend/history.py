@@ -0,0 +1,105 @@
+import json
+from game import GameState
+from poker import Deck
+
+# A game's history is every change to it as an event {"type", "version", "index", "time", ...}, in (version, index) order
+# Engine actions record their inputs (the deck of a deal, the seat and amount of a raise) and showdowns their payouts,
+# direct writes to people and the big blind record what they set
+
+class ReplayError(Exception):
+    pass
+
+# Changes made to the documents directly, applied the same way the endpoints apply them
+def add_person(board, people, event):
+    people.append(dict(event["person"]))
+
+def modify_person(board, people, event):
+    find_person(people, event["person"]).update(event["fields"])
+
+def show(board, people, event):
+    person = find_person(people, event["person"])
+    person["show"] = not person.get("show", True)
+
+def delete_person(board, people, event):
+    person = find_person(people, event["person"])
+    dealer = board.get("dealer", -1)
+    if dealer >= people.index(person):
+        board["dealer"] = dealer - 1
+    people.remove(person)
+
+def big_blind(board, people, event):
+    board["big_blind_value"] = event["value"]
+
+document_events = {
+    "add_person": add_person,
+    "modify_person": modify_person,
+    "show": show,
+    "delete_person": delete_person,
+    "big_blind": big_blind,
+}
+
+def find_person(people, person_id):
+    for person in people:
+        if str(person["_id"]) == str(person_id):
+            return person
+    raise ReplayError(f"Person {person_id} isn't at the table")
+
+def seat(state, index):
+    return None if index is None else state.seats[index]
+
+engine_events = {
+    "deal": lambda state, event: state.deal(Deck(cards=event["deck"])),
+    "undeal": lambda state, event: state.undeal(),
+    "raise": lambda state, event: state.raise_cents(seat(state, event["seat"]), event["amount"]),
+    "call": lambda state, event: state.call(seat(state, event["seat"])),
+    "fold": lambda state, event: state.fold(seat(state, event["seat"])),
+}
+
+# Rebuild a game's state from its history, up to and including until_version
+# Runs the engine on the recorded inputs without reading or writing the database, and checks every showdown pays what it did
+def replay(game_id, events, until_version=None):
+    state = GameState(game_id, {"version": 0}, [])
+    for event in events:
+        if until_version is not None and event["version"] > until_version:
+            break
+        event_type = event["type"]
+        if event_type in engine_events:
+            state.history = []
+            try:
+                engine_events[event_type](state, event)
+            except (IndexError, KeyError, TypeError) as e:
+                # Games started before their history was kept have seats the history never added
+                raise ReplayError(f"Can't replay the {event_type} at version {event['version']}: {e!r}")
+        elif event_type == "showdown":
+            replayed = next((recorded for recorded in reversed(state.history) if recorded["type"] == "showdown"), None)
+            if replayed is None or replayed["payouts"] != event["payouts"]:
+                raise ReplayError(f"The showdown at version {event['version']} paid {event['payouts']}, the replay paid {replayed and replayed['payouts']}")
+        elif event_type in document_events:
+            board, people = state.to_documents()
+            document_events[event_type](board, people, event)
+            state = GameState(game_id, board, people)
+        else:
+            raise ReplayError(f"Unknown event type {event_type}")
+        state.version = event["version"]
+        state.last_active = event.get("time")
+    state.history = []
+    return state
+
+# Group the events into hands, each from a deal to the event before the next deal, holding one hand at a time
+# Events before the first deal, seating the players, are hand 0
+def group_hands(events):
+    hand, hand_events = 0, []
+    for event in events:
+        if event["type"] == "deal" and hand_events:
+            yield {"hand": hand, "events": hand_events}
+            hand_events = []
+        if event["type"] == "deal":
+            hand += 1
+        hand_events.append(event)
+    if hand_events:
+        yield {"hand": hand, "events": hand_events}
+
+# One JSON document per line, ObjectIds become strings
+def to_ndjson(items):
+    for item in items:
+        yield json.dumps(item, default=str) + "\n"
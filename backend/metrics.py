@@ -0,0 +1,85 @@
+import math
+import threading
+
+# Counters and histograms kept in this worker's memory and rendered in Prometheus' text format
+# Each gunicorn worker has its own, Prometheus tells them apart by the instance it scrapes
+
+registry = []
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{escape(value)}"' for name, value in pairs) + "}"
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Counter:
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            for labels, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{format_labels(self.labels, labels)} {format_value(value)}")
+        return lines
+
+# Latency buckets in seconds, Prometheus' defaults
+default_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+class Histogram:
+    def __init__(self, name, help, labels=(), buckets=default_buckets):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        # labels: [count per bucket, sum, count]
+        self.values = {}
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def observe(self, value, *labels):
+        with self.lock:
+            series = self.values.get(labels)
+            if series is None:
+                series = self.values[labels] = [[0] * len(self.buckets), 0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+                    break
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            for labels, (counts, total, count) in sorted(self.values.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    lines.append(f"{self.name}_bucket{format_labels(self.labels, labels, [('le', format_value(bound))])} {cumulative}")
+                lines.append(f"{self.name}_sum{format_labels(self.labels, labels)} {format_value(float(total))}")
+                lines.append(f"{self.name}_count{format_labels(self.labels, labels)} {count}")
+        return lines
+
+def render():
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
@@ -1,7 +1,12 @@
 from collections import Counter
-from itertools import combinations
 import random
 
+# numpy is only needed for scoring hands in batches
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 card_values = {
     '2': 0,
     '3': 1,
@@ -33,12 +38,26 @@ hand_type_dict = {
     0: "High Card"
 }
 
+# Cards are ints from 0 to 51, suit * 13 + rank, and only become strings like 'Ts' for the frontend
+card_strs = [f'{rank}{suit}' for suit in 'shdc' for rank in '23456789TJQKA']
+card_ints = {card_str: card for card, card_str in enumerate(card_strs)}
+
+def cards_to_strs(cards):
+    return [card_strs[card] for card in cards]
+
+def strs_to_cards(strs):
+    return [card_ints[card_str] for card_str in strs]
+
 class Deck:
-    def __init__(self):
-        self.cards = [f'{rank}{suit}' for suit in 'shdc' for rank in '23456789TJQKA']
-        random.shuffle(self.cards)
+    # cards deals a known order, last card first
+    def __init__(self, rng=random, cards=None):
+        if cards is not None:
+            self.cards = list(cards)
+            return
+        self.cards = list(range(52))
+        rng.shuffle(self.cards)
     def deal_card(self):
-        return self.cards.pop(0)
+        return self.cards.pop()
 
 def is_flush(suits):
     return len(set(suits)) == 1
@@ -48,9 +67,9 @@ def is_straight(ranks):
     return all(ranks[i] - 1 == ranks[i+1] for i in range(len(ranks) - 1)) or ranks == [12, 3, 2, 1, 0]
     
 def hand_value(hand):
-    suits = [card[1] for card in hand]
+    suits = [card // 13 for card in hand]
     #ordered decending
-    ranks = sorted([card_values[card[0]] for card in hand], reverse = True)
+    ranks = sorted([card % 13 for card in hand], reverse = True)
 
     flush = is_flush(suits)
     straight = is_straight(ranks)
@@ -97,11 +116,98 @@ def hand_value(hand):
     #high card
     return (ranks[0] << 16) + (ranks[1] << 12) + (ranks[2] << 8) + (ranks[3] << 4) + ranks[4]
 
+# Highest card of a 5 card run in a 13 bit rank mask, -1 if there is none
+def straight_high(rank_mask):
+    for high in range(12, 3, -1):
+        run = 31 << (high - 4)
+        if rank_mask & run == run:
+            return high
+    #special case for A,2,3,4,5
+    wheel = (1 << 12) | 15
+    if rank_mask & wheel == wheel:
+        return 3
+    return -1
+
+def kickers_value(ranks):
+    #packs ranks (decending) into the low nibbles the same way hand_value does
+    value = 0
+    for rank in ranks:
+        value = (value << 4) + rank
+    return value
+
+# Value of the best flush among the cards of one suit, 0 if there are fewer than 5
+def flush_mask_value(rank_mask):
+    if bin(rank_mask).count("1") < 5:
+        return 0
+    high = straight_high(rank_mask)
+    if high == 12:
+        return (9 << 20)
+    if high >= 0:
+        return (8 << 20) + high
+    ranks = [rank for rank in range(12, -1, -1) if rank_mask >> rank & 1]
+    return (5 << 20) + kickers_value(ranks[:5])
+
+# Value of the best 5 card hand that ignores suits, from the count of each rank
+def rank_counts_value(counts):
+    ranks = [rank for rank in range(12, -1, -1) if counts[rank]]
+    quads = [rank for rank in ranks if counts[rank] == 4]
+    trips = [rank for rank in ranks if counts[rank] == 3]
+    pairs = [rank for rank in ranks if counts[rank] == 2]
+    singles = [rank for rank in ranks if counts[rank] == 1]
+
+    if quads:
+        kicker = max(rank for rank in ranks if rank != quads[0])
+        return (7 << 20) + (quads[0] << 4) + kicker
+    if trips and (len(trips) > 1 or pairs):
+        return (6 << 20) + (trips[0] << 4) + max(trips[1:] + pairs)
+
+    high = straight_high(sum(1 << rank for rank in ranks))
+    if high >= 0:
+        return (4 << 20) + high
+    if trips:
+        return (3 << 20) + (trips[0] << 8) + kickers_value(singles[:2])
+    if len(pairs) > 1:
+        kicker = max(pairs[2:] + singles)
+        return (2 << 20) + (pairs[0] << 8) + (pairs[1] << 4) + kicker
+    if pairs:
+        return (1 << 20) + (pairs[0] << 12) + kickers_value(singles[:3])
+    return kickers_value(singles[:5])
+
+# Every card adds 1 to a 3 bit counter for its rank, so a hand's rank key is the sum of its cards' keys
+def rank_key(counts):
+    return sum(count << (3 * rank) for rank, count in enumerate(counts))
+
+def build_rank_table():
+    table = {}
+    def fill(rank, counts, cards_left):
+        if rank < 0:
+            if sum(counts) >= 5:
+                table[rank_key(counts)] = rank_counts_value(counts)
+            return
+        for count in range(min(4, cards_left) + 1):
+            counts[rank] = count
+            fill(rank - 1, counts, cards_left - count)
+        counts[rank] = 0
+    fill(12, [0] * 13, 7)
+    return table
+
+# Lookup tables for scoring 5 to 7 cards without trying every 5 card combination
+flush_table = [flush_mask_value(rank_mask) for rank_mask in range(1 << 13)]
+rank_table = build_rank_table()
+card_rank_keys = [1 << (3 * (card % 13)) for card in range(52)]
+card_rank_bits = [1 << (card % 13) for card in range(52)]
+
 def best_value(seven_hand):
-    best = float('-inf')
-    for five_hand in combinations(seven_hand, 5):
-        best = max(best, hand_value(five_hand))
-    return best
+    key = 0
+    suit_masks = [0, 0, 0, 0]
+    for card in seven_hand:
+        key += card_rank_keys[card]
+        suit_masks[card // 13] |= card_rank_bits[card]
+    #a flush can't be made alongside quads or a full house with 7 cards so it is always the best hand
+    for rank_mask in suit_masks:
+        if flush_table[rank_mask]:
+            return flush_table[rank_mask]
+    return rank_table[key]
 
 def value_to_str(value):
     hand_type = value >> 20
@@ -126,3 +232,31 @@ def value_to_str(value):
     if hand_type == 1:
         return f"One Pair: {hand_values[3]}s with {hand_values[2]}, {hand_values[1]}, and {hand_values[0]} kickers"
     return f"High Card: {hand_values[4]}, {hand_values[3]}, {hand_values[2]}, {hand_values[1]},and {hand_values[0]}"
+
+# numpy versions of the lookup tables, built on the first batch so the server doesn't pay for them
+batch_tables = None
+
+def get_batch_tables():
+    global batch_tables
+    if batch_tables is None:
+        rank_keys = np.array(sorted(rank_table), dtype=np.int64)
+        rank_values = np.array([rank_table[key] for key in sorted(rank_table)], dtype=np.int64)
+        batch_tables = (rank_keys, rank_values, np.array(flush_table, dtype=np.int64))
+    return batch_tables
+
+# Score an (N, 7) array of card ints in one pass, returns the N best_values
+def batch_best_value(hands):
+    if np is None:
+        raise ImportError("batch_best_value requires numpy")
+    rank_keys, rank_values, flush_values = get_batch_tables()
+    hands = np.asarray(hands, dtype=np.int64)
+
+    keys = np.left_shift(1, 3 * (hands % 13)).sum(axis=1)
+    values = rank_values[np.searchsorted(rank_keys, keys)]
+    #one bit per card, so each suit's rank mask is a 13 bit slice of the hand
+    card_masks = np.left_shift(1, hands).sum(axis=1)
+    #a flush always beats whatever the ranks alone make, and has a value of 0 in the table otherwise
+    for suit in range(4):
+        rank_masks = np.right_shift(card_masks, 13 * suit) & 0x1FFF
+        values = np.maximum(values, flush_values[rank_masks])
+    return values
@@ -0,0 +1,183 @@
+import argparse
+import mmap
+import os
+import random
+import struct
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from poker import batch_best_value, card_values, reverse_card_values
+
+# numpy is only needed to build the table
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Preflop equity of the 169 hand classes (pairs, suited and offsuit hands) looked up from a table built offline
+# The table file is a header then little-endian uint16 equities in units of 1/65535:
+#   169 x 169 heads up equity of the row's class against the column's class
+#   169 x 9 equity of each class against 1 to 9 opponents holding random hands
+# Build it with: python backend/preflop.py --samples 10000
+# The server maps the file into memory the first time it is asked for odds, so workers start without reading it
+
+classes = 169
+max_opponents = 9
+header = struct.Struct("<4sHHHI")
+magic = b"PFEQ"
+format_version = 1
+equity_scale = 65535
+
+default_path = os.getenv("PREFLOP_EQUITY_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "preflop_equity.bin"))
+
+# Classes are cells of the 13 x 13 grid by rank, the order of card_values:
+# pairs on the diagonal, suited hands at (high, low) and offsuit hands at (low, high)
+def class_index(high, low, suited):
+    return high * 13 + low if suited else low * 13 + high
+
+# The class of a hand of two card ints, whose ranks are card % 13 in the order of card_values
+def hand_class(hand):
+    first, second = hand
+    high, low = max(first % 13, second % 13), min(first % 13, second % 13)
+    return class_index(high, low, first // 13 == second // 13 and high != low)
+
+def class_name(index):
+    row, column = divmod(index, 13)
+    if row == column:
+        return reverse_card_values[row] * 2
+    if row > column:
+        return reverse_card_values[row] + reverse_card_values[column] + "s"
+    return reverse_card_values[column] + reverse_card_values[row] + "o"
+
+# "AKs", "AKo" or "QQ" to a class, raises ValueError for anything else
+def parse_class(name):
+    name = name.strip()
+    try:
+        high, low = sorted((card_values[name[0].upper()], card_values[name[1].upper()]), reverse=True)
+    except (IndexError, KeyError):
+        raise ValueError(f"Invalid hand class {name!r}")
+    suffix = name[2:].lower()
+    if high == low and suffix == "":
+        return class_index(high, low, False)
+    if high != low and suffix in ("s", "o"):
+        return class_index(high, low, suffix == "s")
+    raise ValueError(f"Invalid hand class {name!r}")
+
+# Every two card combination of a class
+def class_combos(index):
+    row, column = divmod(index, 13)
+    high, low = max(row, column), min(row, column)
+    if row == column:
+        return [(s1 * 13 + high, s2 * 13 + high) for s1 in range(4) for s2 in range(s1 + 1, 4)]
+    if row > column:
+        return [(suit * 13 + high, suit * 13 + low) for suit in range(4)]
+    return [(s1 * 13 + high, s2 * 13 + low) for s1 in range(4) for s2 in range(4) if s1 != s2]
+
+# Random cards from the deck without the known ones, one row per sample
+def random_cards(np_rng, known, count):
+    keys = np_rng.random((len(known), 52))
+    keys[np.arange(len(known))[:, None], known] = 2
+    return np.argpartition(keys, count, axis=1)[:, :count]
+
+# Heads up equity of class row against each later class, wins plus half of ties, over samples random boards
+def heads_up_row(row, samples, seed):
+    np_rng = np.random.default_rng(seed)
+    equities = []
+    for column in range(row + 1, classes):
+        pairs = np.array([hero + villain for hero in class_combos(row) for villain in class_combos(column)
+                          if not set(hero) & set(villain)])
+        holes = pairs[np_rng.integers(len(pairs), size=samples)]
+        boards = random_cards(np_rng, holes, 5)
+        hero = batch_best_value(np.concatenate([holes[:, :2], boards], axis=1))
+        villain = batch_best_value(np.concatenate([holes[:, 2:], boards], axis=1))
+        equities.append(((hero > villain).sum() + 0.5 * (hero == villain).sum()) / samples)
+    return equities
+
+# Equity of class index against 1 to 9 opponents with random hands, the pot is split between tied winners
+def multiway_row(index, samples, seed):
+    np_rng = np.random.default_rng(seed)
+    combos = np.array(class_combos(index))
+    equities = []
+    for opponents in range(1, max_opponents + 1):
+        holes = combos[np_rng.integers(len(combos), size=samples)]
+        cards = random_cards(np_rng, holes, 5 + 2 * opponents)
+        boards = cards[:, :5]
+        values = [batch_best_value(np.concatenate([holes, boards], axis=1))]
+        for i in range(opponents):
+            values.append(batch_best_value(np.concatenate([cards[:, 5 + 2 * i:7 + 2 * i], boards], axis=1)))
+        values = np.stack(values)
+        best = values.max(axis=0)
+        winners = (values == best).sum(axis=0)
+        equities.append(((values[0] == best) / winners).mean())
+    return equities
+
+# Sample both tables across a process pool and write the file, returns the path
+def build(path, samples, seed=0, processes=None):
+    if np is None:
+        raise ImportError("Building the preflop equity table requires numpy")
+    seeds = random.Random(seed)
+    heads_up_seeds = [seeds.getrandbits(64) for _ in range(classes)]
+    multiway_seeds = [seeds.getrandbits(64) for _ in range(classes)]
+    with ProcessPoolExecutor(processes) as pool:
+        heads_up_rows = list(pool.map(heads_up_row, range(classes), [samples] * classes, heads_up_seeds))
+        multiway_rows = list(pool.map(multiway_row, range(classes), [samples] * classes, multiway_seeds))
+
+    # A class against itself breaks even, and the column's equity against the row is what the row doesn't win
+    heads_up = [[0.5] * classes for _ in range(classes)]
+    for row, equities in enumerate(heads_up_rows):
+        for column, equity in enumerate(equities, start=row + 1):
+            heads_up[row][column] = equity
+            heads_up[column][row] = 1 - equity
+    values = [equity for row in heads_up + multiway_rows for equity in row]
+    with open(path, "wb") as f:
+        f.write(header.pack(magic, format_version, classes, max_opponents, samples))
+        f.write(struct.pack(f"<{len(values)}H", *(round(equity * equity_scale) for equity in values)))
+    return path
+
+class TableError(Exception):
+    pass
+
+# The mapped table file, shared by every request in this worker once the first one opens it
+class PreflopTable:
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        file_magic, version, file_classes, file_max_opponents, self.samples = header.unpack_from(self.data)
+        if (file_magic, version, file_classes, file_max_opponents) != (magic, format_version, classes, max_opponents):
+            raise TableError(f"{path} isn't a version {format_version} preflop equity table")
+        if len(self.data) != header.size + 2 * classes * (classes + max_opponents):
+            raise TableError(f"{path} is truncated")
+        self.multiway_offset = header.size + 2 * classes * classes
+
+    def value(self, offset):
+        return struct.unpack_from("<H", self.data, offset)[0] / equity_scale
+
+    # Equity of a class against another
+    def heads_up(self, index, other):
+        return self.value(header.size + 2 * (index * classes + other))
+
+    # Equity of a class against 1 to 9 opponents with random hands
+    def against_random(self, index, opponents):
+        return self.value(self.multiway_offset + 2 * (index * max_opponents + opponents - 1))
+
+tables = {}
+tables_lock = threading.Lock()
+
+# Raises OSError if the table hasn't been built and TableError if the file isn't one
+def get_table(path=default_path):
+    if path not in tables:
+        with tables_lock:
+            if path not in tables:
+                tables[path] = PreflopTable(path)
+    return tables[path]
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--output", default=default_path)
+    parser.add_argument("--samples", type=int, default=10000, help="random boards for each pair of classes and each class and number of opponents")
+    parser.add_argument("--processes", type=int)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    print(f"wrote {build(args.output, args.samples, args.seed, args.processes)}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,314 @@
+import copy
+import threading
+import time
+import pymongo
+from pymongo import errors, monitoring
+from bson import ObjectId
+from poker import strs_to_cards
+
+# Where the games live, every storage has the same methods
+# Boards and people are plain documents keyed by game_id, people are returned sorted by _id
+# Updates of boards and people use Mongo's $set, $unset and $inc operators
+# Actions are saved with commit, which only writes if the board is still at the version the action started from
+# Every change to a game is also appended to its history as events ordered by (version, index)
+
+# Count the commands sent to MongoDB while handling each request
+class RoundTripCounter(monitoring.CommandListener):
+    def __init__(self):
+        self.local = threading.local()
+
+    def reset(self):
+        self.local.count = 0
+
+    def count(self):
+        return getattr(self.local, "count", 0)
+
+    def started(self, event):
+        self.local.count = self.count() + 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+round_trips = RoundTripCounter()
+
+# Cards dealt before they were stored as ints are strings like "Ts", read them as ints so a hand in progress carries on
+# They are written back as ints the next time the field changes
+def upgrade_cards(document, field):
+    if document and document.get(field) and isinstance(document[field][0], str):
+        document[field] = strs_to_cards(document[field])
+    return document
+
+# Indexes of each collection as (name, keys, options)
+# Boards are found by game_id and people by game_id sorted by _id, the unique index also makes new game ids safe to pick at random
+mongo_indexes = {
+    "board": [("game_id_unique", [("game_id", pymongo.ASCENDING)], {"unique": True})],
+    "people": [("game_id_id", [("game_id", pymongo.ASCENDING), ("_id", pymongo.ASCENDING)], {})],
+    "history": [("game_id_version_index", [("game_id", pymongo.ASCENDING), ("version", pymongo.ASCENDING), ("index", pymongo.ASCENDING)],
+                 {"unique": True})],
+}
+
+# Games in a MongoDB cluster, a board document and a people document per person
+class MongoStorage:
+    def __init__(self, uri, database="cluster0"):
+        import certifi
+        self.client = pymongo.MongoClient(uri, tlsCAFile=certifi.where(), event_listeners=[round_trips])
+        self.db = self.client[database]
+        self.people = self.db["people"]
+        self.boards = self.db["board"]
+        self.history = self.db["history"]
+        self.transactions = None
+        # Set once ensure_indexes finds the unique index on the boards' game_id, until then create_game checks first
+        self.unique_game_ids = False
+
+    # Create the indexes the queries rely on, returns "collection.index" for each one that is still missing
+    # Creating an index that exists does nothing, so every worker can run this at startup
+    def ensure_indexes(self, create=True):
+        missing = []
+        for collection_name, indexes in mongo_indexes.items():
+            collection = self.db[collection_name]
+            for name, keys, options in indexes:
+                if create:
+                    try:
+                        collection.create_index(keys, name=name, **options)
+                    except errors.PyMongoError:
+                        pass
+                existing = collection.index_information()
+                if not any(index["key"] == keys and all(index.get(option) == value for option, value in options.items())
+                           for index in existing.values()):
+                    missing.append(f"{collection_name}.{name}")
+        self.unique_game_ids = "board.game_id_unique" not in missing
+        return missing
+
+    # Returns False if a game with the id already exists
+    # Without the unique index, while it is being built or if it couldn't be, a taken id is found by reading it first
+    # That leaves a race between two workers creating the same id, the index closes it
+    def create_game(self, game_id, board):
+        if not self.unique_game_ids and self.boards.find_one({"game_id": game_id}, {"_id": 1}) is not None:
+            return False
+        try:
+            self.boards.insert_one({**board, "game_id": game_id})
+        except errors.DuplicateKeyError:
+            return False
+        return True
+
+    def delete_game(self, game_id):
+        self.boards.delete_one({"game_id": game_id})
+        self.people.delete_many({"game_id": game_id})
+        self.history.delete_many({"game_id": game_id})
+
+    def get_board(self, game_id):
+        return upgrade_cards(self.boards.find_one({"game_id": game_id}), "board_cards")
+
+    # Add one to the board's version and set fields in the same update, returns the new version or None without a board
+    def bump_version(self, game_id, fields=None, upsert=False):
+        update = {"$inc": {"version": 1}}
+        if fields:
+            update["$set"] = fields
+        board = self.boards.find_one_and_update({"game_id": game_id}, update, projection={"version": 1}, upsert=upsert,
+                                                return_document=pymongo.ReturnDocument.AFTER)
+        return board["version"] if board else None
+
+    def get_people(self, game_id):
+        return [upgrade_cards(person, "hand") for person in self.people.find({"game_id": game_id}).sort("_id", pymongo.ASCENDING)]
+
+    # Transactions need a replica set or a sharded cluster, Atlas always has one
+    def supports_transactions(self):
+        if self.transactions is None:
+            try:
+                hello = self.client.admin.command("hello")
+                self.transactions = "setName" in hello or hello.get("msg") == "isdbgrid"
+            except (errors.PyMongoError, NotImplementedError):
+                self.transactions = False
+        return self.transactions
+
+    # Write an action's board update, (_id, update) pairs of people and history events if the board is still at version
+    # new_people are inserted and the people with the _ids in deleted_people removed in the same commit
+    # Returns False without writing anything if another request changed the game first
+    # In a transaction the people are written with the board, without one a reader can briefly see the new board with the old people
+    def commit(self, game_id, version, board_update, people_updates, events=(), new_people=(), deleted_people=()):
+        def write(session=None):
+            if not self.boards.update_one({"game_id": game_id, "version": version}, board_update, session=session).matched_count:
+                return False
+            if new_people:
+                self.people.insert_many([{**person, "game_id": game_id} for person in new_people], session=session)
+            if deleted_people:
+                self.people.delete_many({"_id": {"$in": list(deleted_people)}, "game_id": game_id}, session=session)
+            if people_updates:
+                self.people.bulk_write([pymongo.UpdateOne({"_id": person_id, "game_id": game_id}, update) for person_id, update in people_updates],
+                                       ordered=False, session=session)
+            if events:
+                self.history.insert_many([{**event, "game_id": game_id} for event in events], ordered=False, session=session)
+            return True
+
+        if self.supports_transactions():
+            with self.client.start_session() as session:
+                return session.with_transaction(write)
+        return write()
+
+    # Delete the games not active since cutoff with their people, returns their ids and the numbers of documents deleted
+    # Boards from before last_active was kept are stamped now, so they expire a full timeout later instead of at once
+    # Each board is deleted on its own so a game that turns active during the sweep keeps its people
+    def delete_idle_games(self, now, cutoff):
+        self.boards.update_many({"last_active": {"$exists": False}}, {"$set": {"last_active": now}})
+        game_ids = [board["game_id"] for board in self.boards.find({"last_active": {"$lt": cutoff}}, {"game_id": 1})]
+        deleted = [game_id for game_id in game_ids
+                   if self.boards.delete_one({"game_id": game_id, "last_active": {"$lt": cutoff}}).deleted_count]
+        if not deleted:
+            return deleted, {"board": 0, "people": 0, "history": 0}
+        return deleted, {
+            "board": len(deleted),
+            "people": self.people.delete_many({"game_id": {"$in": deleted}}).deleted_count,
+            "history": self.history.delete_many({"game_id": {"$in": deleted}}).deleted_count
+        }
+
+    # A game's history in order, read from a cursor in batches so a long game is never all in memory
+    def iter_events(self, game_id):
+        return self.history.find({"game_id": game_id}, {"_id": 0, "game_id": 0}).sort(
+            [("version", pymongo.ASCENDING), ("index", pymongo.ASCENDING)]).batch_size(500)
+
+    # The resume token and the _id, as a string, of every board that changes in any worker, after the resume token if given
+    # Raises if the deployment doesn't support change streams
+    def watch_boards(self, resume_after=None):
+        stream = self.boards.watch([{"$match": {"operationType": {"$in": ["update", "replace", "delete"]}}}], resume_after=resume_after)
+
+        def board_ids():
+            with stream:
+                for change in stream:
+                    yield change["_id"], str(change["documentKey"]["_id"])
+
+        return board_ids()
+
+# Apply $set, $unset and $inc to a document in place
+def apply_update(document, update):
+    for key, value in update.get("$set", {}).items():
+        document[key] = copy.deepcopy(value)
+    for key in update.get("$unset", {}):
+        document.pop(key, None)
+    for key, value in update.get("$inc", {}).items():
+        document[key] = document.get(key, 0) + value
+
+# Games in this process's memory, for running offline and benchmarking without a database
+# Documents are copied in and out so callers can't change them by accident
+class MemoryStorage:
+    def __init__(self):
+        self.boards = {}
+        self.people = {}
+        self.history = {}
+        self.lock = threading.Lock()
+
+    # The dicts are keyed by game_id, there is nothing to index
+    def ensure_indexes(self, create=True):
+        return []
+
+    def create_game(self, game_id, board):
+        with self.lock:
+            if game_id in self.boards:
+                return False
+            self.boards[game_id] = {"_id": ObjectId(), **copy.deepcopy(board), "game_id": game_id}
+            self.people.setdefault(game_id, {})
+            return True
+
+    def delete_game(self, game_id):
+        with self.lock:
+            self.boards.pop(game_id, None)
+            self.people.pop(game_id, None)
+            self.history.pop(game_id, None)
+
+    def get_board(self, game_id):
+        with self.lock:
+            return copy.deepcopy(self.boards.get(game_id))
+
+    def bump_version(self, game_id, fields=None, upsert=False):
+        with self.lock:
+            board = self.boards.get(game_id)
+            if board is None:
+                if not upsert:
+                    return None
+                board = self.boards[game_id] = {"_id": ObjectId(), "game_id": game_id}
+            apply_update(board, {"$inc": {"version": 1}, "$set": fields or {}})
+            return board["version"]
+
+    def get_people(self, game_id):
+        with self.lock:
+            people = self.people.get(game_id, {})
+            return [copy.deepcopy(people[person_id]) for person_id in sorted(people)]
+
+    def find_person(self, game_id, person_id):
+        return self.people.get(game_id, {}).get(ObjectId(person_id))
+
+    def commit(self, game_id, version, board_update, people_updates, events=(), new_people=(), deleted_people=()):
+        with self.lock:
+            board = self.boards.get(game_id)
+            if board is None or board.get("version") != version:
+                return False
+            apply_update(board, board_update)
+            people = self.people.setdefault(game_id, {})
+            for person in new_people:
+                people[person["_id"]] = {**copy.deepcopy(person), "game_id": game_id}
+            for person_id in deleted_people:
+                people.pop(person_id, None)
+            for person_id, update in people_updates:
+                person = self.find_person(game_id, person_id)
+                if person is not None:
+                    apply_update(person, update)
+            self.history.setdefault(game_id, []).extend(copy.deepcopy(list(events)))
+            return True
+
+    def delete_idle_games(self, now, cutoff):
+        with self.lock:
+            for board in self.boards.values():
+                board.setdefault("last_active", now)
+            deleted = [game_id for game_id, board in self.boards.items() if board["last_active"] < cutoff]
+            counts = {"board": len(deleted), "people": 0, "history": 0}
+            for game_id in deleted:
+                del self.boards[game_id]
+                counts["people"] += len(self.people.pop(game_id, {}))
+                counts["history"] += len(self.history.pop(game_id, []))
+            return deleted, counts
+
+    # Every change is committed at the next version, so the events are already in order
+    def iter_events(self, game_id):
+        with self.lock:
+            events = list(self.history.get(game_id, []))
+        return (copy.deepcopy(event) for event in events)
+
+    # Every worker has its own memory, so there are no other workers' changes to watch
+    def watch_boards(self, resume_after=None):
+        raise NotImplementedError("Memory storage has no change stream")
+
+# Another storage with a delay before every call like a round trip to a database, for load tests that don't have one
+# The delay is a sleep, so it blocks a gthread worker's thread and only the greenlet of a gevent worker, just like a real round trip
+# Each call is counted as a round trip
+class DelayedStorage:
+    def __init__(self, storage, delay):
+        self.storage = storage
+        self.delay = delay
+
+    def __getattr__(self, name):
+        method = getattr(self.storage, name)
+        if not callable(method):
+            return method
+
+        def delayed(*args, **kwargs):
+            round_trips.started(None)
+            time.sleep(self.delay)
+            return method(*args, **kwargs)
+
+        return delayed
+
+# The storage named by STORAGE, mongo unless it is set, delay seconds late on every call
+# The memory storage loses every game when the worker stops, so it is never picked without asking for it
+def open_storage(name=None, uri=None, delay=0):
+    name = name or "mongo"
+    if name == "mongo":
+        if not uri:
+            raise ValueError("MONGO_URI isn't set, set it or run with STORAGE=memory to keep the games in memory")
+        storage = MongoStorage(uri)
+    elif name == "memory":
+        storage = MemoryStorage()
+    else:
+        raise ValueError(f"Unknown storage {name!r}, expected mongo or memory")
+    return DelayedStorage(storage, delay) if delay > 0 else storage
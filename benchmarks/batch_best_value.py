@@ -0,0 +1,48 @@
+# Compare hands per second of poker.batch_best_value against calling best_value per hand
+# Run from the repo root: python benchmarks/batch_best_value.py --hands 1000000
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend"))
+from poker import best_value, batch_best_value
+
+def random_hands(count, seed):
+    rng = np.random.default_rng(seed)
+    # first 7 cards of count independently shuffled decks
+    return np.argsort(rng.random((count, 52)), axis=1)[:, :7]
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--hands", type=int, default=1000000)
+    parser.add_argument("--scalar-hands", type=int, default=100000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    hands = random_hands(args.hands, args.seed)
+    # build the numpy tables outside of the timed section
+    batch_best_value(hands[:1])
+
+    start = time.perf_counter()
+    batch_values = batch_best_value(hands)
+    batch_seconds = time.perf_counter() - start
+
+    scalar_hands = hands[:args.scalar_hands].tolist()
+    start = time.perf_counter()
+    scalar_values = [best_value(hand) for hand in scalar_hands]
+    scalar_seconds = time.perf_counter() - start
+
+    if batch_values[:len(scalar_values)].tolist() != scalar_values:
+        sys.exit("batch_best_value disagrees with best_value")
+
+    batch_rate = len(hands) / batch_seconds
+    scalar_rate = len(scalar_hands) / scalar_seconds
+    print(f"best_value:       {scalar_rate:>12,.0f} hands/s ({len(scalar_hands):,} hands)")
+    print(f"batch_best_value: {batch_rate:>12,.0f} hands/s ({len(hands):,} hands)")
+    print(f"speedup:          {batch_rate / scalar_rate:>12.1f}x")
+
+if __name__ == "__main__":
+    main()
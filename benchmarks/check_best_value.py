@@ -0,0 +1,65 @@
+# Check best_value against the best hand_value over every 5 card combination, the scoring it replaced
+# Covers every 5 card hand, every rank multiset of 5 to 7 cards, every suited rank mask of 5 to 7 cards and random 7 card hands
+# Run from the repo root: python benchmarks/check_best_value.py
+import argparse
+import os
+import random
+import sys
+from itertools import combinations, combinations_with_replacement
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend"))
+from poker import best_value, cards_to_strs, hand_value
+
+def reference_value(hand):
+    return max(hand_value(list(combo)) for combo in combinations(hand, 5))
+
+# Every 5 card hand, where best_value and hand_value score the same 5 cards
+def five_card_hands():
+    return combinations(range(52), 5)
+
+# One hand per multiset of ranks with no rank more than 4 times
+# Card i gets suit i % 4, copies of a rank are next to each other so they get different suits and no suit has a flush
+def rank_multisets():
+    for size in (5, 6, 7):
+        for ranks in combinations_with_replacement(range(13), size):
+            if max(ranks.count(rank) for rank in set(ranks)) <= 4:
+                yield [(i % 4) * 13 + rank for i, rank in enumerate(ranks)]
+
+# One hand per set of 5 to 7 ranks in each suit
+def suited_rank_masks():
+    for size in (5, 6, 7):
+        for ranks in combinations(range(13), size):
+            for suit in range(4):
+                yield [suit * 13 + rank for rank in ranks]
+
+def random_hands(count, seed):
+    rng = random.Random(seed)
+    for _ in range(count):
+        yield rng.sample(range(52), 7)
+
+def check(name, hands):
+    checked = 0
+    for hand in hands:
+        hand = list(hand)
+        expected = hand_value(hand) if len(hand) == 5 else reference_value(hand)
+        if best_value(hand) != expected:
+            sys.exit(f"{name}: best_value({cards_to_strs(hand)}) is {best_value(hand)}, expected {expected}")
+        checked += 1
+    print(f"{name:<20} {checked:>12,} hands match")
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--random", type=int, default=100000, help="random 7 card hands to check as well")
+    parser.add_argument("--skip-five", action="store_true", help="skip the 2,598,960 five card hands for a quick run")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    if not args.skip_five:
+        check("five_card_hands", five_card_hands())
+    check("rank_multisets", rank_multisets())
+    check("suited_rank_masks", suited_rank_masks())
+    check("random_hands", random_hands(args.random, args.seed))
+    print("ok")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+# Compare how many tables one gunicorn worker keeps responsive with gthread threads and with gevent greenlets
+# Each mode serves the app on the memory storage, with STORAGE_DELAY standing in for MongoDB's round trips
+# Run from the repo root: python benchmarks/load_tables.py --tables 16 32 64 128 --delay 0.02
+# --events also keeps an event stream open for every table, like a browser watching it
+import argparse
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import Counter
+
+from stress_actions import HttpClient, backend
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+# One worker, the memory storage isn't shared between workers
+def start_server(worker_class, port, args):
+    env = {**os.environ, "STORAGE": "memory", "STORAGE_DELAY": str(args.delay), "WRITE_BEHIND_DELAY": "0",
+           "GAME_IDLE_TIMEOUT": "0", "EVENT_KEEPALIVE": "1"}
+    command = [sys.executable, "-m", "gunicorn", "--pythonpath", backend, "--worker-class", worker_class,
+               "--threads", str(args.threads), "--worker-connections", str(args.worker_connections), "--workers", "1",
+               "--bind", f"127.0.0.1:{port}", "--log-level", "warning", "app:app"]
+    server = subprocess.Popen(command, env=env)
+    client = HttpClient(f"http://127.0.0.1:{port}", timeout=1)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            client.request("GET", "/games/0/poker/board")
+            return server
+        except (OSError, ValueError):
+            time.sleep(0.2)
+    server.kill()
+    sys.exit(f"gunicorn with {worker_class} workers didn't start")
+
+def create_table(client, players):
+    game_id = client.request("POST", "/games")[1]["game_id"]
+    for i in range(players):
+        client.request("POST", f"/games/{game_id}/people", {"name": f"player {i}", "dollars": 1000})
+    client.request("POST", f"/games/{game_id}/poker/big_blind", {"bigBlind": 1})
+    return game_id
+
+# A table polls its state about every interval seconds and acts for whoever's turn it is, timing every request
+def play_table(client, game_id, deadline, interval, latencies, statuses, rng):
+    def timed(method, path, body=None):
+        start = time.perf_counter()
+        try:
+            status, body = client.request(method, path, body)
+        except (OSError, ValueError):
+            status, body = "error", None
+        latencies.append(time.perf_counter() - start)
+        statuses[status] += 1
+        return status, body
+
+    while time.monotonic() < deadline:
+        time.sleep(interval * rng.uniform(0.5, 1.5))
+        status, state = timed("GET", f"/games/{game_id}/state")
+        if status != 200:
+            continue
+        board = state["board"]
+        if board.get("current", -1) < 0 or board.get("game_state", 4) >= 4:
+            timed("POST", f"/games/{game_id}/poker/deal")
+            continue
+        person_id = state["people"][board["current"]]["_id"]
+        action = rng.random()
+        if action < 0.1:
+            timed("POST", f"/games/{game_id}/poker/fold/{person_id}")
+        elif action < 0.25:
+            timed("POST", f"/games/{game_id}/poker/raise/{person_id}", {"amount": board.get("min_raise", 100)})
+        else:
+            timed("POST", f"/games/{game_id}/poker/call/{person_id}")
+
+# Hold a table's event stream open until the deadline, a stream that can't start in time counts as an error
+def watch_table(url, game_id, deadline, statuses):
+    try:
+        with urllib.request.urlopen(f"{url}/games/{game_id}/events", timeout=5) as response:
+            while time.monotonic() < deadline and response.readline():
+                pass
+        statuses["stream"] += 1
+    except (OSError, urllib.error.URLError):
+        statuses["stream_error"] += 1
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(fraction * len(values)))] if values else float("nan")
+
+def run_level(url, tables, args):
+    client = HttpClient(url, timeout=args.timeout)
+    game_ids = [create_table(client, args.players) for _ in range(tables)]
+    latencies, statuses = [], Counter()
+    deadline = time.monotonic() + args.seconds
+    threads = [threading.Thread(target=play_table, args=(client, game_id, deadline, args.interval, latencies, statuses, random.Random(args.seed + i)))
+               for i, game_id in enumerate(game_ids)]
+    if args.events:
+        threads += [threading.Thread(target=watch_table, args=(url, game_id, deadline, statuses)) for game_id in game_ids]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for game_id in game_ids:
+        client.request("POST", f"/games/delete/{game_id}")
+
+    latencies.sort()
+    errors = statuses["error"] + statuses["stream_error"] + sum(count for status, count in statuses.items() if isinstance(status, int) and status >= 500)
+    return {"tables": tables, "requests": len(latencies), "rate": len(latencies) / args.seconds, "errors": errors,
+            "p50": percentile(latencies, 0.5), "p95": percentile(latencies, 0.95), "p99": percentile(latencies, 0.99)}
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--modes", nargs="+", default=["gthread", "gevent"], help="gunicorn worker classes to compare")
+    parser.add_argument("--tables", nargs="+", type=int, default=[16, 32, 64, 128], help="numbers of concurrent tables to try")
+    parser.add_argument("--delay", type=float, default=0.02, help="seconds each storage call takes, a round trip to MongoDB")
+    parser.add_argument("--interval", type=float, default=0.5, help="seconds between a table's polls")
+    parser.add_argument("--seconds", type=float, default=10, help="length of each level")
+    parser.add_argument("--players", type=int, default=4)
+    parser.add_argument("--events", action="store_true", help="keep an event stream open for every table")
+    parser.add_argument("--slo", type=float, default=0.5, help="95th percentile seconds a level may take to count as served")
+    parser.add_argument("--timeout", type=float, default=10, help="seconds before a request counts as an error")
+    parser.add_argument("--threads", type=int, default=32, help="threads of a gthread worker, as in the Procfile")
+    parser.add_argument("--worker-connections", type=int, default=1000, help="greenlets of a gevent worker")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    results = {}
+    for mode in args.modes:
+        port = free_port()
+        server = start_server(mode, port, args)
+        try:
+            results[mode] = [run_level(f"http://127.0.0.1:{port}", tables, args) for tables in args.tables]
+        finally:
+            server.terminate()
+            server.wait()
+
+    print(f"{'mode':<10} {'tables':>7} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'errors':>7}")
+    capacity = {}
+    for mode, levels in results.items():
+        for level in levels:
+            print(f"{mode:<10} {level['tables']:>7} {level['rate']:>8.0f} {level['p50'] * 1000:>8.0f} {level['p95'] * 1000:>8.0f} "
+                  f"{level['p99'] * 1000:>8.0f} {level['errors']:>7}")
+        served = [level["tables"] for level in levels if level["p95"] <= args.slo and not level["errors"]]
+        capacity[mode] = max(served, default=0)
+    for mode, tables in capacity.items():
+        print(f"{mode} serves {tables} tables with a p95 under {args.slo * 1000:.0f} ms")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"delay": args.delay, "interval": args.interval, "events": args.events, "results": results, "capacity": capacity}, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,45 @@
+# Compare rebuilding a game from its history with playing it through the HTTP endpoints, and check both end the same
+# Run from the repo root: python benchmarks/replay.py --hands 200
+import argparse
+import random
+import sys
+import time
+
+from suite import play_hands
+from history import replay
+
+# The fields replaying can't know, the board's _id is made by the storage
+def comparable(board, people):
+    board = {key: value for key, value in board.items() if key != "_id"}
+    return board, people
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--hands", type=int, default=200)
+    parser.add_argument("--players", type=int, default=6)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    import app
+    client = app.app.test_client()
+    random.seed(args.seed)
+    start = time.perf_counter()
+    game_id = play_hands(client, args.hands, args.players, random.Random(args.seed), delete=False)
+    http_seconds = time.perf_counter() - start
+
+    events = list(app.storage.iter_events(game_id))
+    start = time.perf_counter()
+    state = replay(game_id, events)
+    replay_seconds = time.perf_counter() - start
+
+    stored = comparable(app.storage.get_board(game_id), app.storage.get_people(game_id))
+    if comparable(*state.to_documents()) != stored:
+        sys.exit("The replayed game doesn't match the stored one")
+
+    print(f"events:  {len(events):>10,}")
+    print(f"http:    {args.hands / http_seconds:>10,.0f} hands/s")
+    print(f"replay:  {args.hands / replay_seconds:>10,.0f} hands/s")
+    print(f"speedup: {http_seconds / replay_seconds:>10.1f}x")
+
+if __name__ == "__main__":
+    main()
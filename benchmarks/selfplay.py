@@ -0,0 +1,275 @@
+# Play many tables of bots against the game engine with no database or HTTP, and check the rules after every action
+# Run from the repo root: python benchmarks/selfplay.py --tables 2000 --hands 50 --processes 8
+# Soak for a while instead of a number of hands: python benchmarks/selfplay.py --tables 500 --seconds 600
+# Every table has its own seed, rerun one that broke a rule with --table
+import argparse
+import json
+import os
+import random
+import sys
+import time
+import traceback
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend"))
+from game import GameState
+from history import document_events
+from poker import Deck
+
+# Bots choose ("fold" | "call" | "raise", amount) for the seat whose turn it is
+# They only make moves the frontend allows: a raise at least the minimum raise unless it is all in, and never more than the seat has
+def raise_limits(state, seat):
+    to_call = (state.bet_per_person or 0) - (seat.betted or 0)
+    most = seat.cents - to_call
+    return min(state.min_raise or 0, most), most
+
+def random_bot(state, seat, rng):
+    least, most = raise_limits(state, seat)
+    choice = rng.random()
+    if choice < 0.15:
+        return "fold", None
+    if choice < 0.3 and seat.can_raise and most > 0:
+        return "raise", rng.randint(least, max(least, min(most, 4 * least)))
+    return "call", None
+
+def calling_bot(state, seat, rng):
+    return "call", None
+
+def aggressive_bot(state, seat, rng):
+    least, most = raise_limits(state, seat)
+    if seat.can_raise and most > 0 and rng.random() < 0.5:
+        return "raise", least
+    return "call", None
+
+# Goes all in often, so hands end with side pots
+def shoving_bot(state, seat, rng):
+    least, most = raise_limits(state, seat)
+    choice = rng.random()
+    if choice < 0.2 and seat.can_raise and most > 0:
+        return "raise", most
+    if choice < 0.4:
+        return "fold", None
+    return "call", None
+
+bots = {
+    "random": random_bot,
+    "caller": calling_bot,
+    "aggressive": aggressive_bot,
+    "shover": shoving_bot,
+}
+
+# Seconds spent in each engine method, including the methods it calls:
+# raise_cents, call and fold call increment_current, which calls evaluate_winner at the end of a hand
+timings = {}
+
+def timed(name, method):
+    def run(self, *args):
+        start = time.perf_counter()
+        try:
+            return method(self, *args)
+        finally:
+            calls, seconds = timings.get(name, (0, 0.0))
+            timings[name] = (calls + 1, seconds + time.perf_counter() - start)
+    return run
+
+class TimedGameState(GameState):
+    __slots__ = ()
+
+for name in ("deal", "raise_cents", "call", "fold", "increment_current", "evaluate_winner"):
+    setattr(TimedGameState, name, timed(name, getattr(GameState, name)))
+
+class RuleBroken(Exception):
+    pass
+
+# A table of bots, its own random numbers make it play the same way every run
+class Table:
+    def __init__(self, number, args):
+        self.number = number
+        self.rng = random.Random(f"{args.seed}-{number}")
+        self.args = args
+        self.next_id = 0
+        self.hands = 0
+        self.actions = 0
+        self.hand_actions = 0
+        people = [self.new_person() for _ in range(self.rng.randint(args.min_players, args.max_players))]
+        self.state = TimedGameState(f"table-{number}", {"big_blind_value": args.big_blind, "version": 0}, people)
+        # Money brought to the table minus money taken away, what the seats and pot must add up to
+        self.chips = sum(person["cents"] for person in people)
+
+    def new_person(self):
+        self.next_id += 1
+        return {"_id": self.next_id, "name": f"bot {self.next_id}", "cents": self.args.buy_in,
+                "bot": self.rng.choice(self.args.bots)}
+
+    # Change the documents like the endpoints do and load the table again
+    def change_documents(self, event):
+        board, people = self.state.to_documents()
+        document_events[event["type"]](board, people, event)
+        self.state = TimedGameState(self.state.game_id, board, people)
+
+    # Between hands players leave, join and buy back in
+    def churn(self):
+        rng, args = self.rng, self.args
+        seats = self.state.seats
+        if len(seats) > args.min_players and rng.random() < args.churn:
+            leaving = rng.choice(seats)
+            self.chips -= leaving.cents
+            self.change_documents({"type": "delete_person", "person": leaving.id})
+        if len(self.state.seats) < args.max_players and rng.random() < args.churn:
+            person = self.new_person()
+            self.chips += person["cents"]
+            self.change_documents({"type": "add_person", "person": person})
+        for seat in self.state.seats:
+            if seat.cents == 0:
+                self.chips += args.buy_in
+                self.change_documents({"type": "modify_person", "person": seat.id, "fields": {"cents": args.buy_in}})
+
+    def check(self, hand_over):
+        state = self.state
+        seats = state.seats
+        pot = state.pot or 0
+        total = sum(seat.cents for seat in seats) + pot
+        if total != self.chips:
+            raise RuleBroken("chips", f"the seats and pot hold {total}, {self.chips} were brought to the table")
+        negative = [seat.index for seat in seats if seat.cents < 0]
+        if negative:
+            raise RuleBroken("negative_cents", f"seats {negative} have less than nothing")
+        if state.dealer is not None and not -1 <= state.dealer < len(seats):
+            raise RuleBroken("dealer", f"dealer {state.dealer} with {len(seats)} seats")
+        if state.money_mask != sum(seat.bit for seat in seats if seat.cents > 0):
+            raise RuleBroken("money_mask", f"{state.money_mask:b} doesn't match the seats with money")
+        if state.cards_mask != sum(seat.bit for seat in seats if seat.hand is not None):
+            raise RuleBroken("cards_mask", f"{state.cards_mask:b} doesn't match the seats with cards")
+        if pot and sum(side_pot["amount"] for side_pot in state.side_pots or []) != pot:
+            raise RuleBroken("side_pots", f"the side pots hold {sum(side_pot['amount'] for side_pot in state.side_pots)} of a {pot} pot")
+        if hand_over:
+            if pot:
+                raise RuleBroken("pot_left", f"{pot} left in the pot after the hand")
+            if state.side_pots:
+                raise RuleBroken("side_pots_left", f"side pots {state.side_pots} left after the hand")
+        elif state.current is None or not 0 <= state.current < len(seats) or not state.cards_mask & state.money_mask & seats[state.current].bit:
+            raise RuleBroken("current", f"seat {state.current} is to act but can't")
+        if self.hand_actions > self.args.max_actions:
+            raise RuleBroken("endless_hand", f"the hand is still going after {self.hand_actions} actions")
+
+    def hand_over(self):
+        return self.state.game_state is None or self.state.game_state >= 4
+
+    # Deal or act once, returns False when the table has played its hands
+    def step(self):
+        state = self.state
+        if self.hand_over():
+            if self.hands >= self.args.hands:
+                return False
+            state.history = []
+            self.churn()
+            self.hands += 1
+            self.hand_actions = 0
+            self.state.deal(Deck(self.rng))
+        else:
+            seat = state.seats[state.current]
+            action, amount = bots[seat.other["bot"]](state, seat, self.rng)
+            if action == "raise":
+                state.raise_cents(seat, amount)
+            elif action == "call":
+                state.call(seat)
+            else:
+                state.fold(seat)
+            self.actions += 1
+            self.hand_actions += 1
+        self.check(self.hand_over())
+        return True
+
+    def describe(self):
+        board, people = self.state.to_documents()
+        return {"board": board, "people": people, "events": self.state.history}
+
+# Play the tables a step each in turn until every one has played its hands or the deadline passes
+# A table stops at the first rule it breaks
+def play_tables(numbers, args, deadline):
+    timings.clear()
+    tables = [Table(number, args) for number in numbers]
+    violations = []
+    hands = actions = 0
+    start = time.perf_counter()
+    while tables and (deadline is None or time.time() < deadline):
+        playing = []
+        for table in tables:
+            try:
+                if table.step():
+                    playing.append(table)
+                    continue
+            except RuleBroken as e:
+                check, detail = e.args
+                violations.append({"table": table.number, "hand": table.hands, "check": check, "detail": detail,
+                                   **(table.describe() if args.table is not None else {})})
+            except Exception:
+                violations.append({"table": table.number, "hand": table.hands, "check": "exception", "detail": traceback.format_exc(limit=3)})
+            hands += table.hands
+            actions += table.actions
+        tables = playing
+    # Tables still playing at the deadline
+    hands += sum(table.hands for table in tables)
+    actions += sum(table.actions for table in tables)
+    return {"hands": hands, "actions": actions, "seconds": time.perf_counter() - start, "violations": violations, "timings": dict(timings)}
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tables", type=int, default=1000)
+    parser.add_argument("--hands", type=int, default=100, help="hands per table")
+    parser.add_argument("--seconds", type=float, help="stop after this long even if the hands aren't played, for a soak with a large --hands")
+    parser.add_argument("--processes", type=int, default=os.cpu_count())
+    parser.add_argument("--bots", nargs="+", choices=sorted(bots), default=sorted(bots), help="strategies the players are picked from")
+    parser.add_argument("--min-players", type=int, default=2)
+    parser.add_argument("--max-players", type=int, default=9)
+    parser.add_argument("--churn", type=float, default=0.1, help="chance a player leaves and one joins between hands")
+    parser.add_argument("--buy-in", type=int, default=10000, help="cents")
+    parser.add_argument("--big-blind", type=int, default=100, help="cents")
+    parser.add_argument("--max-actions", type=int, default=1000, help="actions in a hand before it counts as endless")
+    parser.add_argument("--table", type=int, help="play only this table and print the state and events of a broken rule")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    numbers = [args.table] if args.table is not None else list(range(args.tables))
+    processes = max(1, min(args.processes, len(numbers)))
+    deadline = time.time() + args.seconds if args.seconds else None
+    start = time.perf_counter()
+    with ProcessPoolExecutor(processes) as pool:
+        results = list(pool.map(play_tables, [numbers[i::processes] for i in range(processes)], [args] * processes, [deadline] * processes))
+    seconds = time.perf_counter() - start
+
+    hands = sum(result["hands"] for result in results)
+    actions = sum(result["actions"] for result in results)
+    violations = sorted((violation for result in results for violation in result["violations"]), key=lambda violation: violation["table"])
+    phases = {}
+    for result in results:
+        for name, (calls, phase_seconds) in result["timings"].items():
+            total_calls, total_seconds = phases.get(name, (0, 0.0))
+            phases[name] = (total_calls + calls, total_seconds + phase_seconds)
+
+    print(f"tables:     {len(numbers):>12,} in {processes} processes")
+    print(f"hands:      {hands:>12,} {hands / seconds:>12,.0f} hands/s")
+    print(f"actions:    {actions:>12,} {actions / seconds:>12,.0f} actions/s")
+    print(f"{'phase':<20} {'calls':>12} {'mean':>10}")
+    for name, (calls, phase_seconds) in phases.items():
+        print(f"{name:<20} {calls:>12,} {phase_seconds / calls * 1e6:>8.1f}us")
+    for check, count in sorted(Counter(violation["check"] for violation in violations).items()):
+        print(f"{check:<20} {count:>12,} tables")
+    for violation in violations[:10]:
+        print(f"table {violation['table']} hand {violation['hand']}: {violation['check']}: {violation['detail']}")
+    if args.table is not None and violations:
+        print(json.dumps(violations[0], indent=2, default=str))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"tables": len(numbers), "hands": hands, "actions": actions, "seconds": seconds, "rate": hands / seconds,
+                       "phases": {name: {"calls": calls, "seconds": phase_seconds} for name, (calls, phase_seconds) in phases.items()},
+                       "violations": violations}, f, indent=2, default=str)
+
+    if violations:
+        sys.exit(f"{len(violations)} table(s) broke a rule")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+# Fire concurrent actions, double taps included, at one game and check that no money was made or lost
+# Run from the repo root: python benchmarks/stress_actions.py --workers 4 --threads 16
+# By default each worker is a separate copy of the app sharing one in-memory storage, like gunicorn workers sharing a database
+# --url runs against a deployed server instead
+import argparse
+import importlib.util
+import json
+import os
+import random
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import Counter
+
+backend = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend")
+sys.path.insert(0, backend)
+os.environ["STORAGE"] = "memory"
+os.environ["WRITE_BEHIND_DELAY"] = "0"
+
+# Copies of the app module with their own locks and memory, only the storage is shared
+def load_workers(count):
+    modules = []
+    for i in range(count):
+        spec = importlib.util.spec_from_file_location(f"app_worker_{i}", os.path.join(backend, "app.py"))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        if modules:
+            module.storage = modules[0].storage
+        modules.append(module)
+    return [module.app.test_client() for module in modules]
+
+class LocalClient:
+    def __init__(self, workers):
+        self.workers = workers
+
+    def request(self, method, path, body=None):
+        response = random.choice(self.workers).open(path, method=method, json=body)
+        return response.status_code, response.get_json()
+
+class HttpClient:
+    def __init__(self, url, timeout=None):
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+
+    def request(self, method, path, body=None):
+        data = json.dumps(body).encode() if body is not None else None
+        request = urllib.request.Request(self.url + path, data=data, method=method, headers={"Content-Type": "application/json"})
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                return response.status, json.loads(response.read() or "null")
+        except urllib.error.HTTPError as e:
+            return e.code, json.loads(e.read() or "null")
+
+def total_cents(state):
+    return sum(person["cents"] for person in state["people"]) + (state["board"].get("pot") or 0)
+
+# Play until the deadline, acting for whoever's turn it was when the state was read
+def play(client, game_id, deadline, statuses, rng):
+    while time.monotonic() < deadline:
+        status, state = client.request("GET", f"/games/{game_id}/state")
+        statuses[status] += 1
+        board = state["board"]
+        if board.get("current", -1) < 0 or board.get("game_state", 4) >= 4:
+            statuses[client.request("POST", f"/games/{game_id}/poker/deal")[0]] += 1
+            continue
+        person_id = state["people"][board["current"]]["_id"]
+        choice = rng.random()
+        if choice < 0.1:
+            path, body = f"/games/{game_id}/poker/fold/{person_id}", None
+        elif choice < 0.3:
+            path, body = f"/games/{game_id}/poker/raise/{person_id}", {"amount": board.get("min_raise", 100)}
+        elif choice < 0.35:
+            path, body = f"/games/{game_id}/poker/show/{person_id}", None
+        else:
+            path, body = f"/games/{game_id}/poker/call/{person_id}", None
+        # Double tap
+        for _ in range(2 if rng.random() < 0.3 else 1):
+            statuses[client.request("POST", path, body)[0]] += 1
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", help="server to stress, by default copies of the app run in this process")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--players", type=int, default=6)
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    client = HttpClient(args.url) if args.url else LocalClient(load_workers(args.workers))
+    game_id = client.request("POST", "/games")[1]["game_id"]
+    for i in range(args.players):
+        client.request("POST", f"/games/{game_id}/people", {"name": f"player {i}", "dollars": 1000})
+    client.request("POST", f"/games/{game_id}/poker/big_blind", {"bigBlind": 1})
+    start = total_cents(client.request("GET", f"/games/{game_id}/state")[1])
+
+    thread_statuses = [Counter() for _ in range(args.threads)]
+    deadline = time.monotonic() + args.seconds
+    threads = [threading.Thread(target=play, args=(client, game_id, deadline, thread_statuses[i], random.Random(args.seed + i)))
+               for i in range(args.threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    statuses = sum(thread_statuses, Counter())
+
+    state = client.request("GET", f"/games/{game_id}/state")[1]
+    client.request("POST", f"/games/delete/{game_id}")
+    print(f"requests by status: {dict(sorted(statuses.items()))}")
+    print(f"final version: {state['version']}")
+    problems = []
+    if total_cents(state) != start:
+        problems.append(f"money at the table went from {start} to {total_cents(state)}")
+    side_pots = state["board"].get("side_pots") or []
+    if state["board"].get("pot") and sum(side_pot["amount"] for side_pot in side_pots) != state["board"]["pot"]:
+        problems.append("the side pots don't add up to the pot")
+    if statuses[500]:
+        problems.append(f"{statuses[500]} requests failed")
+    if problems:
+        sys.exit("\n".join(problems))
+    print("ok")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+# Time the hand evaluator, the showdown and a full hand through the HTTP endpoints
+# Run from the repo root: python benchmarks/suite.py --output bench.json
+# Compare against a stored run, exits with 1 if anything got slower than the tolerance:
+#   python benchmarks/suite.py --output bench.json --baseline baseline.json
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend"))
+# The HTTP benchmark runs against the in-memory storage so it measures the app, not the database
+os.environ["STORAGE"] = "memory"
+os.environ["WRITE_BEHIND_DELAY"] = "0"
+from poker import Deck, best_value, hand_value, value_to_str
+from game import GameState
+
+def random_hands(count, size, rng):
+    return [Deck(rng).cards[:size] for _ in range(count)]
+
+# Best ops per second over the repeats, setup(count) builds the inputs outside of the timed section
+def measure(run, setup, count, repeat):
+    best = None
+    for _ in range(repeat):
+        inputs = setup(count)
+        start = time.perf_counter()
+        run(inputs)
+        seconds = time.perf_counter() - start
+        if best is None or seconds < best:
+            best = seconds
+    return {"ops": count, "seconds": best, "rate": count / best}
+
+def bench_hand_value(count, repeat, rng):
+    return measure(lambda hands: [hand_value(hand) for hand in hands], lambda count: random_hands(count, 5, rng), count, repeat)
+
+def bench_best_value(count, repeat, rng):
+    return measure(lambda hands: [best_value(hand) for hand in hands], lambda count: random_hands(count, 7, rng), count, repeat)
+
+def bench_value_to_str(count, repeat, rng):
+    return measure(lambda values: [value_to_str(value) for value in values],
+                   lambda count: [best_value(hand) for hand in random_hands(count, 7, rng)], count, repeat)
+
+# A table at the river where every player went all in for a different amount, so each one makes a side pot
+def showdown_state(players, rng):
+    deck = Deck(rng)
+    people = []
+    for i in range(players):
+        betted = rng.randint(1, 1000) * 10
+        people.append({"_id": i, "cents": 0, "betted": betted, "hand": [deck.deal_card() for _ in range(2)],
+                       "can_raise": False, "show": False, "won": 0, "score": 0, "score_str": ""})
+    board = {"board_cards": [deck.deal_card() for _ in range(5)], "game_state": 3,
+             "pot": sum(person["betted"] for person in people)}
+    state = GameState("bench", board, people)
+    state.rebuild_side_pots()
+    return state
+
+def bench_evaluate_winner(players):
+    def bench(count, repeat, rng):
+        return measure(lambda states: [state.evaluate_winner() for state in states],
+                       lambda count: [showdown_state(players, rng) for _ in range(count)], count, repeat)
+    return bench
+
+# Create a game, seat the players and play hands to the showdown with random raises, calls and folds
+# Returns the game's ID, the game is deleted at the end unless delete is False
+def play_hands(client, hands, players, rng, delete=True):
+    game_id = client.post("/games").get_json()["game_id"]
+    for i in range(players):
+        client.post(f"/games/{game_id}/people", json={"name": f"player {i}", "dollars": 100})
+    client.post(f"/games/{game_id}/poker/big_blind", json={"bigBlind": 1})
+    for _ in range(hands):
+        # Top everyone back up so the game never ends
+        for person in client.get(f"/games/{game_id}/people").get_json():
+            if person["cents"] < 2000:
+                client.put(f"/games/{game_id}/people/{person['_id']}", json={"name": person["name"], "dollars": 100})
+        client.post(f"/games/{game_id}/poker/deal")
+        while True:
+            state = client.get(f"/games/{game_id}/state").get_json()
+            board = state["board"]
+            if board.get("current", -1) < 0 or board.get("game_state", 4) >= 4:
+                break
+            person_id = state["people"][board["current"]]["_id"]
+            action = rng.random()
+            if action < 0.15:
+                client.post(f"/games/{game_id}/poker/fold/{person_id}")
+            elif action < 0.3:
+                client.post(f"/games/{game_id}/poker/raise/{person_id}", json={"amount": board.get("min_raise", 100)})
+            else:
+                client.post(f"/games/{game_id}/poker/call/{person_id}")
+    if delete:
+        client.post(f"/games/delete/{game_id}")
+    return game_id
+
+def bench_http_hand(players):
+    def bench(count, repeat, rng):
+        from app import app
+        client = app.test_client()
+        return measure(lambda count: play_hands(client, count, players, rng), lambda count: count, count, repeat)
+    return bench
+
+# name: (benchmark, default count, unit)
+benchmarks = {
+    "hand_value": (bench_hand_value, 100000, "hands"),
+    "best_value": (bench_best_value, 100000, "hands"),
+    "value_to_str": (bench_value_to_str, 100000, "values"),
+    **{f"evaluate_winner_{players}": (bench_evaluate_winner(players), 20000, "showdowns") for players in range(2, 11)},
+    "http_hand_3": (bench_http_hand(3), 200, "hands"),
+    "http_hand_6": (bench_http_hand(6), 200, "hands"),
+}
+
+# Rate of each benchmark against the baseline, the names that got slower than the tolerance
+def compare(results, baseline, tolerance):
+    regressions = []
+    print(f"{'benchmark':<20} {'baseline':>14} {'current':>14} {'change':>8}")
+    for name, result in results.items():
+        if name not in baseline:
+            print(f"{name:<20} {'-':>14} {result['rate']:>14,.0f}")
+            continue
+        change = result["rate"] / baseline[name]["rate"] - 1
+        flag = ""
+        if change < -tolerance:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print(f"{name:<20} {baseline[name]['rate']:>14,.0f} {result['rate']:>14,.0f} {change:>+8.1%}{flag}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="compare with the results in this JSON file")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="fraction a rate may drop before it is a regression")
+    parser.add_argument("--only", nargs="+", help="run the benchmarks whose names start with these prefixes")
+    parser.add_argument("--scale", type=float, default=1.0, help="multiply every count, below 1 for a quick run")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    results = {}
+    for name, (bench, count, unit) in benchmarks.items():
+        if args.only and not any(name.startswith(prefix) for prefix in args.only):
+            continue
+        # Same inputs for a benchmark however many of the others run
+        random.seed(args.seed)
+        result = bench(max(1, int(count * args.scale)), args.repeat, random.Random(args.seed))
+        result["unit"] = unit
+        results[name] = result
+        if not args.baseline:
+            print(f"{name:<20} {result['rate']:>14,.0f} {unit}/s")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"python": platform.python_version(), "machine": platform.machine(), "results": results}, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            sys.exit(f"{len(regressions)} regression(s): {', '.join(regressions)}")
+
+if __name__ == "__main__":
+    main()